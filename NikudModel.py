@@ -2,30 +2,69 @@ import gzip
 import os
 import tarfile
 
+import numpy as np
 import torch
 from pathlib import Path
 import logging
 from logging.handlers import RotatingFileHandler
-from transformers import AutoModel, AutoTokenizer
-from src.models import DNikudModel, ModelConfig
+from transformers import AutoConfig, AutoModel, AutoTokenizer
+from src.models import DNikudModel, ModelConfig, quantize_dynamic
 import shutil
 
 # Import your custom modules
-from src.models_utils import predict
+from model_store import check_model_store, load_state_dict, save_state_dict, write_manifest
+from model_export import EXPORT_EXTENSIONS, ExportedDNikudPipeline, ExportedGraph
+from models.Dicta.BertForDiacritization import decode_predictions, remove_nikkud
+from src.char_tokenizer import CharTokenizer, load_tavbert_tokenizer, save_tokenizer_bundle
+from src.inference import DNikudInferencePipeline, STRIP_NIKUD_TABLE
 from src.running_params import BATCH_SIZE, MAX_LENGTH_SEN
-from src.utiles_data import NikudDataset, Nikud, create_missing_folders
+from src.utiles_data import Nikud, create_missing_folders
+from text_segmentation import segment_text
+
+# DictaBERT attention is quadratic in the text length, so longer texts are predicted in windows of this many chars
+DICTA_MAX_SEGMENT_LENGTH = 512
+
 
 class NikudModel:
-    def __init__(self, model_path: str, device: str, config_path: str, compressed_path: str):
+    def __init__(self, model_path: str, device: str, config_path: str, compressed_path: str,
+                 inference_mode: bool = True, quantize: bool = False, verify_store: bool = False):
+        if quantize and device != "cpu":
+            raise ValueError("Dynamic quantization only runs on CPU")
+
         self.model_path = model_path
         self.device = device
         self.config_path = config_path
         self.compressed_path = compressed_path
+        self.inference_mode = inference_mode
+        self.quantize = quantize
+
+        # a prepared model store holds the weights ready to be memory mapped, so the archive parts aren't needed
+        self.store_ready = check_model_store(self.store_folder(), verify_store)
 
         # Ensure model is extracted before loading
-        if compressed_path:
+        if compressed_path and not self.store_ready:
             self.extract_split_tar_gz(compressed_path)
 
+    def store_folder(self) -> str:
+        return self.model_path if os.path.isdir(self.model_path) else os.path.dirname(self.model_path)
+
+    def prepare_store(self):
+        """
+        Writes the weights as safetensors next to the model, with a manifest of the model files checksums.
+        Later loads memory map the weights instead of extracting the archive parts and reading them into memory.
+        """
+        raise NotImplementedError
+
+    def freeze(self, model: torch.nn.Module) -> torch.nn.Module:
+        # serving never trains, so with inference mode on the weights don't need to track gradients either
+        model.eval()
+        if self.inference_mode:
+            model.requires_grad_(False)
+        if self.quantize:
+            # int8 Linear and LSTM weights, quantizing takes a few seconds so it's done once at load time
+            model = quantize_dynamic(model)
+        return model
+
     def predict_multiple(self, sentences: list[str]) -> list[str]:
         results = []
         for sentence in sentences:
@@ -35,6 +74,15 @@ class NikudModel:
     def predict(self, sentence: str) -> str:
         raise NotImplementedError
 
+    def identity(self) -> str:
+        # identifies the model for caching, outputs of models with different identities are never mixed
+        identity = f"{type(self).__name__}:{os.path.abspath(self.model_path)}"
+        return f"{identity}:int8" if self.quantize else identity
+
+    def normalize(self, sentence: str) -> str:
+        # the part of the input the output depends on, inputs with the same normalized form get the same output
+        return sentence
+
     # Function to extract and reassemble the model file
     def extract_split_tar_gz(self, dir_path: str):
         dir_path = Path(dir_path)
@@ -78,14 +126,102 @@ class NikudModel:
             tar_path.unlink()
 
 class DictaBERTModel(NikudModel):
-    def __init__(self, model_path: str, device: str, config_path: str, compressed_path: str):
-        super().__init__(model_path, device, config_path, compressed_path)
+    def __init__(self, model_path: str, device: str, config_path: str, compressed_path: str,
+                 inference_mode: bool = True, quantize: bool = False, verify_store: bool = False,
+                 max_segment_length: int = DICTA_MAX_SEGMENT_LENGTH):
+        super().__init__(model_path, device, config_path, compressed_path, inference_mode, quantize, verify_store)
         self.tokenizer = AutoTokenizer.from_pretrained(model_path, local_files_only=True)
-        self.model = AutoModel.from_pretrained(model_path, trust_remote_code=True, local_files_only=True)
-        self.model.eval()
+        self.model = self.load_model()
+
+        # BertForDiacritization.predict only takes sentences up to the tokenizer max length (with 2 special tokens)
+        self.max_segment_length = min(max_segment_length, self.tokenizer.model_max_length - 2)
+
+    def load_model(self):
+        # low_cpu_mem_usage skips initializing weights that are overwritten right away
+        options = {"use_safetensors": True} if self.store_ready else {}
+        model = AutoModel.from_pretrained(self.model_path, trust_remote_code=True, local_files_only=True,
+                                          low_cpu_mem_usage=True, **options)
+        return self.freeze(model)
+
+    def prepare_store(self):
+        weights_path = os.path.join(self.model_path, "model.safetensors")
+        if not os.path.exists(weights_path):
+            state_dict = torch.load(os.path.join(self.model_path, "pytorch_model.bin"), map_location="cpu")
+            save_state_dict(state_dict, weights_path)
+
+        files = [weights_path] + [os.path.join(self.model_path, name) for name in
+                                  ["config.json", "tokenizer.json", "tokenizer_config.json", "special_tokens_map.json",
+                                   "vocab.txt"]]
+        write_manifest(self.model_path, [file for file in files if os.path.exists(file)])
+
+    def exported_path(self, export_format: str) -> str:
+        return os.path.join(self.model_path, f"model{EXPORT_EXTENSIONS[export_format]}")
 
     def predict(self, sentence: str) -> str:
-        return self.model.predict([sentence], self.tokenizer)[0]
+        return self.predict_multiple([sentence])[0]
+
+    def identity(self) -> str:
+        # long texts are predicted window by window, so the window size changes the output
+        return f"{super().identity()}:{self.max_segment_length}"
+
+    def normalize(self, sentence: str) -> str:
+        # BertForDiacritization.predict drops any nikud in the input
+        return remove_nikkud(sentence)
+
+    def predict_multiple(self, sentences: list[str]) -> list[str]:
+        # long texts are split into windows at sentence and punctuation boundaries, the windows of all the
+        # texts are predicted together and each text is stitched back from its windows
+        segments = [segment_text(remove_nikkud(sentence), self.max_segment_length) for sentence in sentences]
+        windows = [window for sentence_segments in segments for window in sentence_segments]
+
+        # sort by length so each forward pass pads to similar lengths, then restore the input order
+        results = [None] * len(windows)
+        order = sorted(range(len(windows)), key=lambda i: len(windows[i]))
+        for start in range(0, len(order), BATCH_SIZE):
+            indices = order[start:start + BATCH_SIZE]
+            for i, output in zip(indices, self.predict_windows([windows[i] for i in indices])):
+                results[i] = output
+
+        outputs = iter(results)
+        return ["".join(next(outputs) for _ in sentence_segments) for sentence_segments in segments]
+
+    def predict_windows(self, windows: list[str]) -> list[str]:
+        return self.model.predict(windows, self.tokenizer, inference_mode=self.inference_mode)
+
+
+class ExportedDictaBERTModel(DictaBERTModel):
+    """
+    DictaBERTModel that runs the graph exported by main.py export instead of the eager model.
+    Tokenization, windowing and decoding are the same, only the forward pass and the argmax run in the graph.
+    """
+
+    def __init__(self, model_path: str, device: str, config_path: str, compressed_path: str,
+                 inference_mode: bool = True, quantize: bool = False,
+                 verify_store: bool = False, max_segment_length: int = DICTA_MAX_SEGMENT_LENGTH,
+                 export_format: str = "onnx"):
+        if device != "cpu" or quantize:
+            raise ValueError("Exported graphs run on CPU, without quantization")
+
+        self.export_format = export_format
+        super().__init__(model_path, device, config_path, compressed_path, inference_mode, quantize, verify_store,
+                         max_segment_length)
+
+    def load_model(self):
+        # decoding only needs the nikud and shin classes of the config
+        self.config = AutoConfig.from_pretrained(self.model_path, local_files_only=True)
+        return ExportedGraph(self.exported_path(self.export_format))
+
+    def identity(self) -> str:
+        # the graph runtimes don't round exactly like eager pytorch
+        return f"{super().identity()}:{self.export_format}"
+
+    def predict_windows(self, windows: list[str]) -> list[str]:
+        inputs = self.tokenizer(windows, padding='longest', truncation=True, return_tensors='np',
+                                return_offsets_mapping=True)
+        nikud_predictions, shin_predictions = self.model(inputs['input_ids'].astype(np.int64),
+                                                         inputs['attention_mask'].astype(np.int64))
+        return decode_predictions(self.config, windows, inputs['offset_mapping'], nikud_predictions,
+                                  shin_predictions)
 
 
 def get_logger():
@@ -104,25 +240,121 @@ def get_logger():
     return logger
 
 class DNikudNikudModel(NikudModel):
-    def __init__(self, model_path: str, device: str, config_path: str, compressed_path: str):
-        super().__init__(model_path, device, config_path, compressed_path)
+    pipeline_class = DNikudInferencePipeline
+
+    def __init__(self, model_path: str, device: str, config_path: str, compressed_path: str,
+                 inference_mode: bool = True, quantize: bool = False, verify_store: bool = False,
+                 padding: str = "max_length", bucketing: bool = False):
+        super().__init__(model_path, device, config_path, compressed_path, inference_mode, quantize, verify_store)
+        self.padding = padding
+        self.bucketing = bucketing
 
         self.logger = get_logger()
 
-        # Load model and tokenizer
-        self.tokenizer_tavbert = AutoTokenizer.from_pretrained("tau/tavbert-he")
-        config = ModelConfig.load_from_file(config_path)
+        # Load model and tokenizer, from the local bundle when prepare_store saved one
+        self.tokenizer_tavbert = load_tavbert_tokenizer(self.tokenizer_folder(), char_level=True)
+        self.config = ModelConfig.load_from_file(config_path)
+        self.dnikud_model = self.load_model()
+
+        self.pipeline = self.pipeline_class(self.dnikud_model, self.tokenizer_tavbert, device=device,
+                                            batch_size=BATCH_SIZE, max_length=MAX_LENGTH_SEN,
+                                            padding=padding, bucketing=bucketing,
+                                            inference_mode=inference_mode)
+
+    def load_model(self):
+        dnikud_model = DNikudModel(self.config, len(Nikud.label_2_id["nikud"]), len(Nikud.label_2_id["dagesh"]),
+                                   len(Nikud.label_2_id["sin"]), device=self.device).to(self.device)
+        state_dict_model = dnikud_model.state_dict()
+        if self.store_ready:
+            # the parameters take the memory mapped tensors as they are, instead of copying them
+            state_dict_model.update(load_state_dict(self.store_weights_path()))
+            dnikud_model.load_state_dict(state_dict_model, assign=True)
+            dnikud_model.to(self.device)
+        else:
+            state_dict_model.update(torch.load(self.model_path, map_location=self.device))
+            dnikud_model.load_state_dict(state_dict_model)
+        return self.freeze(dnikud_model)
+
+    def store_weights_path(self) -> str:
+        return f"{os.path.splitext(self.model_path)[0]}.safetensors"
+
+    def tokenizer_folder(self) -> str:
+        return os.path.join(self.store_folder(), "tokenizer")
 
-        self.dnikud_model = DNikudModel(config, len(Nikud.label_2_id["nikud"]), len(Nikud.label_2_id["dagesh"]),
-                                   len(Nikud.label_2_id["sin"]), device=device).to(device)
-        state_dict_model = self.dnikud_model.state_dict()
-        state_dict_model.update(torch.load(model_path, map_location=device))
-        self.dnikud_model.load_state_dict(state_dict_model)
-        self.dnikud_model.eval()
+    def prepare_store(self):
+        save_state_dict(torch.load(self.model_path, map_location="cpu"), self.store_weights_path())
+        # the char tokenizer is built from the HF tokenizer, which is already loaded unless a bundle was saved
+        tokenizer = self.tokenizer_tavbert
+        if isinstance(tokenizer, CharTokenizer):
+            tokenizer = load_tavbert_tokenizer(self.tokenizer_folder())
+        tokenizer_files = save_tokenizer_bundle(tokenizer, self.tokenizer_folder())
+        write_manifest(self.store_folder(), [self.store_weights_path(), self.config_path] + tokenizer_files)
+
+    def exported_path(self, export_format: str) -> str:
+        return f"{os.path.splitext(self.model_path)[0]}{EXPORT_EXTENSIONS[export_format]}"
 
     def predict(self, sentence: str) -> str:
-        dataset = NikudDataset(self.tokenizer_tavbert, data_list=[sentence], logger=self.logger, max_length=MAX_LENGTH_SEN)
-        dataset.prepare_data(name="prediction")
-        mtb_prediction_dl = torch.utils.data.DataLoader(dataset.prepered_data, batch_size=BATCH_SIZE)
-        all_labels = predict(self.dnikud_model, mtb_prediction_dl, self.device)
-        return dataset.back_2_text(labels=all_labels)
+        return self.predict_multiple([sentence])[0]
+
+    def predict_multiple(self, sentences: list[str]) -> list[str]:
+        return self.pipeline.predict(sentences)
+
+    def identity(self) -> str:
+        # the padding changes what the Bi-LSTM sees, and with it the output
+        return f"{super().identity()}:{self.padding}"
+
+    def normalize(self, sentence: str) -> str:
+        # the pipeline drops any nikud in the input
+        return sentence.translate(STRIP_NIKUD_TABLE)
+
+
+class ExportedDNikudNikudModel(DNikudNikudModel):
+    """
+    DNikudNikudModel that runs the graph exported by main.py export instead of the eager model.
+    Tokenization and decoding are the same, only the forward pass and the argmax run in the graph.
+    """
+
+    pipeline_class = ExportedDNikudPipeline
+
+    def __init__(self, model_path: str, device: str, config_path: str, compressed_path: str,
+                 inference_mode: bool = True, quantize: bool = False, verify_store: bool = False,
+                 padding: str = "max_length", bucketing: bool = False, export_format: str = "onnx"):
+        if device != "cpu" or quantize:
+            raise ValueError("Exported graphs run on CPU, without quantization")
+
+        self.export_format = export_format
+        super().__init__(model_path, device, config_path, compressed_path, inference_mode, quantize, verify_store,
+                         padding, bucketing)
+
+    def load_model(self):
+        return ExportedGraph(self.exported_path(self.export_format))
+
+    def identity(self) -> str:
+        # the graph runtimes don't round exactly like eager pytorch
+        return f"{super().identity()}:{self.export_format}"
+
+
+MODEL_PATHS = {
+    # model name: (model path, config path, compressed parts folder)
+    "dnikud": ('models/Dnikud/Dnikud_best_model.pth', 'models/Dnikud/config.yml', 'models/Dnikud'),
+    "dicta": ('./models/Dicta', 'models/Dicta/config.json', './models/Dicta'),
+}
+
+
+# eager pytorch, or one of the exported graph formats
+BACKENDS = ["eager"] + list(EXPORT_EXTENSIONS)
+
+
+def load_nikud_model(model_name: str, device: str, backend: str = "eager", **kwargs) -> NikudModel:
+    if model_name not in MODEL_PATHS:
+        raise ValueError(f"Invalid model: {model_name}")
+    if backend not in BACKENDS:
+        raise ValueError(f"Invalid backend: {backend}")
+
+    model_path, config_path, compressed_path = MODEL_PATHS[model_name]
+    if backend == "eager":
+        model_class = DNikudNikudModel if model_name == "dnikud" else DictaBERTModel
+    else:
+        model_class = ExportedDNikudNikudModel if model_name == "dnikud" else ExportedDictaBERTModel
+        kwargs["export_format"] = backend
+    return model_class(model_path, device, config_path, compressed_path, **kwargs)
@@ -1,41 +1,112 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 import torch
-import os
-import re
 
-from NikudModel import DNikudNikudModel, DictaBERTModel
+from NikudModel import BACKENDS, DICTA_MAX_SEGMENT_LENGTH, load_nikud_model
+from batching import MicroBatcher
+from manual_fixes import ManualFixes
+from prediction_cache import CachedNikudModel, PredictionCache
+from streaming import completed_future, ndjson_error, ndjson_line, stream_predictions
 
 app = Flask(__name__)
 
 import argparse
 
-def parse_args():
-    parser = argparse.ArgumentParser(description="Run Nikud model script")
+def create_arg_parser(description="Run Nikud model script"):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        "--host",
+        default="0.0.0.0",
+        help="Address to listen on (default: 0.0.0.0)"
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=5000,
+        help="Port to listen on (default: 5000)"
+    )
     parser.add_argument(
         "--model",
         choices=["dnikud", "dicta"],
         default="dicta",
         help="Choose which model to use (default: dicta)"
     )
-    return parser.parse_args()
-
-# Load manual fixes
-def load_manual_fixes(fixes_file):
-    fixes = []
-    if os.path.exists(fixes_file):
-        with open(fixes_file, "r", encoding="utf-8") as f:
-            next(f)  # Skip the first line
-            for line in f:
-                parts = line.strip().split("|a|")
-                if len(parts) == 2:
-                    fixes.append((re.escape(parts[0]), parts[1]))
-    return fixes
+    parser.add_argument(
+        "--backend",
+        choices=BACKENDS,
+        default="eager",
+        help="Run the model in eager pytorch, or run its graph exported by 'python main.py export', CPU only "
+             "(default: eager)"
+    )
+    parser.add_argument(
+        "--quantize",
+        action="store_true",
+        help="Run the model with dynamically quantized int8 Linear and LSTM layers, CPU only"
+    )
+    parser.add_argument(
+        "--verify_model_store",
+        action="store_true",
+        help="Check the checksums of the model store at startup, which reads all the weights once"
+    )
+    parser.add_argument(
+        "--max_batch_size",
+        type=int,
+        default=8,
+        help="Maximum number of concurrent /predict requests run in one forward pass, 1 disables batching (default: 8)"
+    )
+    parser.add_argument(
+        "--max_wait_ms",
+        type=float,
+        default=5.0,
+        help="Maximum time in milliseconds a request waits for others to join its batch (default: 5)"
+    )
+    parser.add_argument(
+        "--dnikud_padding",
+        choices=["max_length", "longest"],
+        default="max_length",
+        help="D-Nikud padding: 'max_length' pads every text to 1024 tokens as in training, "
+             "'longest' pads each batch only to its longest text (default: max_length)"
+    )
+    parser.add_argument(
+        "--dnikud_bucketing",
+        action="store_true",
+        help="With --dnikud_padding longest, batch D-Nikud texts of similar length together"
+    )
+    parser.add_argument(
+        "--dicta_max_segment_length",
+        type=int,
+        default=DICTA_MAX_SEGMENT_LENGTH,
+        help=f"DictaBERT predicts longer texts in windows of at most this many chars, split at sentence and "
+             f"punctuation boundaries (default: {DICTA_MAX_SEGMENT_LENGTH})"
+    )
+    parser.add_argument(
+        "--cache_size",
+        type=int,
+        default=10000,
+        help="Maximum number of cached predictions, 0 disables the cache (default: 10000)"
+    )
+    parser.add_argument(
+        "--cache_max_mb",
+        type=float,
+        default=64,
+        help="Maximum memory in MB taken by the cached predictions (default: 64)"
+    )
+    parser.add_argument(
+        "--cache_per_sentence",
+        action="store_true",
+        help="Cache and predict texts sentence by sentence instead of whole, so partially repeated texts hit the "
+             "cache, at the cost of each sentence being predicted without its neighbours"
+    )
+    return parser
+
+
+def parse_args():
+    return create_arg_parser().parse_args()
 
 MANUAL_FIXES_FILE = "manual_fixes.txt"
-manual_fixes = load_manual_fixes(MANUAL_FIXES_FILE)
+manual_fixes = ManualFixes(MANUAL_FIXES_FILE)
 
 def apply_manual_fixes(text):
-    return re.sub("|".join(before for before, _ in manual_fixes), lambda m: dict(manual_fixes)[re.escape(m.group(0))], text)
+    return manual_fixes.apply(text)
 
 @app.route("/predict", methods=["POST"])
 def predict_text():
@@ -46,7 +117,10 @@ def predict_text():
     text = data["text"]
     print(f"Got text: {text}")
 
-    output = nikud_model.predict(text)
+    if batcher is not None:
+        output = batcher.predict(text)
+    else:
+        output = nikud_model.predict(text)
 
     # Apply manual fixes using regex
     output_fixed = apply_manual_fixes(output)
@@ -56,23 +130,84 @@ def predict_text():
     return jsonify({"diacritized_text": output_fixed})
 
 
+@app.route("/predict_batch", methods=["POST"])
+def predict_batch():
+    data = request.json
+    texts = data.get("texts")
+    if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+        return jsonify({"error": "Missing 'texts' field, expected a list of strings"}), 400
+
+    print(f"Got {len(texts)} texts")
+
+    outputs = nikud_model.predict_multiple(texts)
+    outputs_fixed = [apply_manual_fixes(output) for output in outputs]
+
+    return jsonify({"diacritized_texts": outputs_fixed})
+
+
+def submit_sentence(sentence):
+    if batcher is not None:
+        return batcher.submit(sentence)
+    return completed_future(nikud_model.predict, sentence)
+
+
+def stream_max_pending():
+    # two batches ahead: one running while the previous one is sent
+    return 2 * batcher.max_batch_size if batcher is not None else 1
+
+
+@app.route("/predict_stream", methods=["POST"])
+def predict_stream():
+    data = request.json
+    if "text" not in data:
+        return jsonify({"error": "Missing 'text' field"}), 400
+
+    text = data["text"]
+    print(f"Got text to stream: {len(text)} chars")
+
+    def generate():
+        try:
+            for index, future in enumerate(stream_predictions(text, submit_sentence, stream_max_pending())):
+                yield ndjson_line(index, apply_manual_fixes(future.result()))
+        except Exception as e:
+            yield ndjson_error(e)
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
+@app.route("/stats", methods=["GET"])
+def stats():
+    return jsonify({"batching": batcher.stats() if batcher is not None else None,
+                    "cache": cache.stats() if cache is not None else None})
+
+
 DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
-DNIKUD_MODEL_PATH = 'models/Dnikud/Dnikud_best_model.pth'
-DNIKUD_MODEL_CONFIG_PATH = 'models/Dnikud/config.yml'
-COMPRESSED_DNIKUD_PARTS_PREFIX = 'models/Dnikud'
 
-DICTA_MODEL_PATH = './models/Dicta'
-DICTA_MODEL_CONFIG_PATH = 'models/Dicta/config.json'
-COMPRESSED_DICTA_PARTS_PREFIX = './models/Dicta'
+def load_server_model(args, device=None):
+    model_options = {"backend": args.backend, "quantize": args.quantize, "verify_store": args.verify_model_store}
+    if args.model == "dnikud":
+        model_options.update(padding=args.dnikud_padding, bucketing=args.dnikud_bucketing)
+    elif args.model == "dicta":
+        model_options.update(max_segment_length=args.dicta_max_segment_length)
+
+    # quantized kernels and exported graphs only run on CPU
+    device = "cpu" if args.quantize or args.backend != "eager" else device or DEVICE
+    nikud_model = load_nikud_model(args.model, device, **model_options)
+
+    cache = None
+    if args.cache_size > 0:
+        cache = PredictionCache(max_entries=args.cache_size, max_bytes=int(args.cache_max_mb * 1024 * 1024))
+        nikud_model = CachedNikudModel(nikud_model, cache, per_sentence=args.cache_per_sentence)
+
+    batcher = None
+    if args.max_batch_size > 1:
+        batcher = MicroBatcher(nikud_model.predict_multiple, max_batch_size=args.max_batch_size,
+                               max_wait_ms=args.max_wait_ms)
 
-args = parse_args()
+    return nikud_model, cache, batcher
 
-if args.model == "dnikud":
-    nikud_model = DNikudNikudModel(DNIKUD_MODEL_PATH, DEVICE, DNIKUD_MODEL_CONFIG_PATH, COMPRESSED_DNIKUD_PARTS_PREFIX)
-elif args.model == "dicta":
-    nikud_model = DictaBERTModel(DICTA_MODEL_PATH, DEVICE, DICTA_MODEL_CONFIG_PATH, COMPRESSED_DICTA_PARTS_PREFIX)
-else:
-    raise ValueError(f"Invalid model: {args.model}")
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000)
+    args = parse_args()
+    nikud_model, cache, batcher = load_server_model(args)
+    app.run(host=args.host, port=args.port)
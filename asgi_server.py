@@ -0,0 +1,210 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+from Nikud_server import apply_manual_fixes, create_arg_parser, load_server_model
+from streaming import ndjson_error, ndjson_line, stream_predictions
+
+
+class AdmissionControl:
+    """
+    Bounds the requests handled at once: up to max_in_flight run, up to max_queued more wait for a slot
+    and anything beyond that is rejected right away.
+
+    A request admitted by try_admit must call leave when it is done, whatever happens to it. It runs inside
+    `async with admission`, which holds one of the max_in_flight slots.
+    """
+
+    def __init__(self, max_in_flight, max_queued):
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.pending = 0
+        self.rejected = 0
+        self._slots = None
+
+    def try_admit(self):
+        # only called from the event loop thread, so the counter needs no lock
+        if self.pending >= self.max_in_flight + self.max_queued:
+            self.rejected += 1
+            return False
+        self.pending += 1
+        return True
+
+    def leave(self):
+        self.pending -= 1
+
+    async def __aenter__(self):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_in_flight)
+        await self._slots.acquire()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._slots.release()
+
+    def stats(self):
+        return {"max_in_flight": self.max_in_flight,
+                "max_queued": self.max_queued,
+                "pending": self.pending,
+                "rejected": self.rejected}
+
+
+class AdmittedResponse:
+    """
+    Sends a response and then gives its request's admission back, also when the client goes away or the
+    request is cancelled before or while the body is sent.
+    """
+
+    def __init__(self, response, admission):
+        self.response = response
+        self.admission = admission
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await self.response(scope, receive, send)
+        finally:
+            self.admission.leave()
+
+
+async def read_json(request: Request):
+    # None when the body is not a JSON object
+    try:
+        data = await request.json()
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def create_app(nikud_model, cache, batcher, executor, admission):
+    async def run_in_executor(func, *args):
+        return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+    async def diacritize(text):
+        if batcher is not None:
+            # the batcher runs the model on its own thread, only wait for its result here
+            output = await asyncio.wrap_future(batcher.submit(text))
+        else:
+            output = await run_in_executor(nikud_model.predict, text)
+        return await run_in_executor(apply_manual_fixes, output)
+
+    async def diacritize_batch(texts):
+        outputs = await run_in_executor(nikud_model.predict_multiple, texts)
+        return await run_in_executor(lambda: [apply_manual_fixes(output) for output in outputs])
+
+    def submit_sentence(sentence):
+        if batcher is not None:
+            return batcher.submit(sentence)
+        return executor.submit(nikud_model.predict, sentence)
+
+    # two batches ahead: one running while the previous one is sent
+    max_pending = 2 * batcher.max_batch_size if batcher is not None else 2
+
+    def overloaded():
+        return JSONResponse({"error": "Server is overloaded, try again later"}, status_code=503)
+
+    def invalid_json():
+        return JSONResponse({"error": "Request body must be a JSON object"}, status_code=400)
+
+    async def predict_text(request: Request):
+        data = await read_json(request)
+        if data is None:
+            return invalid_json()
+        if "text" not in data:
+            return JSONResponse({"error": "Missing 'text' field"}, status_code=400)
+
+        if not admission.try_admit():
+            return overloaded()
+        try:
+            async with admission:
+                output_fixed = await diacritize(data["text"])
+        finally:
+            admission.leave()
+        return JSONResponse({"diacritized_text": output_fixed})
+
+    async def predict_batch(request: Request):
+        data = await read_json(request)
+        if data is None:
+            return invalid_json()
+        texts = data.get("texts")
+        if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+            return JSONResponse({"error": "Missing 'texts' field, expected a list of strings"}, status_code=400)
+
+        if not admission.try_admit():
+            return overloaded()
+        try:
+            async with admission:
+                outputs_fixed = await diacritize_batch(texts)
+        finally:
+            admission.leave()
+        return JSONResponse({"diacritized_texts": outputs_fixed})
+
+    async def predict_stream(request: Request):
+        data = await read_json(request)
+        if data is None:
+            return invalid_json()
+        if "text" not in data:
+            return JSONResponse({"error": "Missing 'text' field"}, status_code=400)
+
+        if not admission.try_admit():
+            return overloaded()
+
+        async def generate():
+            # the stream holds an in-flight slot until the last line is sent or the client goes away
+            async with admission:
+                try:
+                    for index, future in enumerate(stream_predictions(data["text"], submit_sentence, max_pending)):
+                        output = await asyncio.wrap_future(future)
+                        yield ndjson_line(index, await run_in_executor(apply_manual_fixes, output))
+                except Exception as e:
+                    yield ndjson_error(e)
+
+        # the admission is given back by the response, which runs even if the body is never iterated
+        return AdmittedResponse(StreamingResponse(generate(), media_type="application/x-ndjson"), admission)
+
+    async def stats(request: Request):
+        return JSONResponse({"batching": batcher.stats() if batcher is not None else None,
+                             "cache": cache.stats() if cache is not None else None,
+                             "admission": admission.stats()})
+
+    return Starlette(routes=[
+        Route("/predict", predict_text, methods=["POST"]),
+        Route("/predict_batch", predict_batch, methods=["POST"]),
+        Route("/predict_stream", predict_stream, methods=["POST"]),
+        Route("/stats", stats, methods=["GET"]),
+    ])
+
+
+def parse_args():
+    parser = create_arg_parser(description="Run Nikud model async server")
+    parser.add_argument(
+        "--executor_threads",
+        type=int,
+        default=4,
+        help="Number of threads running the model and the manual fixes (default: 4)"
+    )
+    parser.add_argument(
+        "--max_in_flight",
+        type=int,
+        default=64,
+        help="Maximum number of requests handled at once (default: 64)"
+    )
+    parser.add_argument(
+        "--max_queued",
+        type=int,
+        default=256,
+        help="Maximum number of requests waiting for a slot, more are rejected with 503 (default: 256)"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    nikud_model, cache, batcher = load_server_model(args)
+    executor = ThreadPoolExecutor(max_workers=args.executor_threads, thread_name_prefix="nikud-model")
+    admission = AdmissionControl(args.max_in_flight, args.max_queued)
+
+    uvicorn.run(create_app(nikud_model, cache, batcher, executor, admission), host=args.host, port=args.port)
@@ -0,0 +1,102 @@
+import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+from queue import Queue, Empty
+
+
+class MicroBatcher:
+    """
+    Coalesces concurrent single-text requests into batched model calls.
+
+    Pending texts are collected until either `max_batch_size` texts are waiting or `max_wait_ms`
+    milliseconds have passed since the first of them arrived, and are then handed to `predict_fn`
+    (a `list[str] -> list[str]` callable) in a single call. Each caller gets back its own result.
+    """
+
+    def __init__(self, predict_fn, max_batch_size: int = 8, max_wait_ms: float = 5.0):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+
+        self._queue = None
+        self._worker = None
+        self._worker_pid = None
+        self._start_lock = threading.Lock()
+
+        self._stats_lock = threading.Lock()
+        self.batch_sizes = Counter()
+
+    def predict(self, text: str, timeout: float = None) -> str:
+        return self.submit(text).result(timeout)
+
+    def submit(self, text: str) -> Future:
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((text, future))
+        return future
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            sizes = dict(sorted(self.batch_sizes.items()))
+        num_batches = sum(sizes.values())
+        num_requests = sum(size * count for size, count in sizes.items())
+        return {"max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait * 1000.0,
+                "batches": num_batches,
+                "requests": num_requests,
+                "mean_batch_size": num_requests / num_batches if num_batches else 0.0,
+                "batch_size_histogram": sizes}
+
+    def _ensure_worker(self):
+        # threads don't survive a fork, so the worker is started lazily inside the serving process
+        if self._worker_pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._worker_pid == os.getpid():
+                return
+            self._queue = Queue()
+            self._worker = threading.Thread(target=self._run, name="nikud-micro-batcher", daemon=True)
+            self._worker.start()
+            self._worker_pid = os.getpid()
+
+    def _run(self):
+        queue = self._queue
+        while True:
+            batch = [queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(queue.get(timeout=remaining))
+                except Empty:
+                    break
+            self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        batch = [(text, future) for text, future in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+
+        with self._stats_lock:
+            self.batch_sizes[len(batch)] += 1
+
+        try:
+            results = self.predict_fn([text for text, _ in batch])
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+                return
+            # one bad text shouldn't fail the requests it was batched with, so each text is predicted on its own
+            for text, future in batch:
+                try:
+                    future.set_result(self.predict_fn([text])[0])
+                except Exception as text_error:
+                    future.set_exception(text_error)
+            return
+
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
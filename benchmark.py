@@ -0,0 +1,511 @@
+# general
+import argparse
+import importlib
+import json
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+from sample_texts import SAMPLE_TEXTS
+
+# training, evaluation and plotting dependencies the serving entry points shouldn't import
+HEAVY_MODULES = ["matplotlib.pyplot", "seaborn", "pandas", "sklearn.metrics", "tqdm", "glob2"]
+
+
+def peak_rss_mb():
+    # ru_maxrss is reported in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def time_calls(func, repeat):
+    latencies = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - start_time)
+    return {"mean_ms": statistics.mean(latencies) * 1000,
+            "p50_ms": statistics.median(latencies) * 1000,
+            "max_ms": max(latencies) * 1000}
+
+
+def run_in_subprocess(command, run_args):
+    # every measured configuration runs in a fresh interpreter so peak RSS isn't shared between them
+    output = subprocess.check_output([sys.executable, __file__, command] + run_args)
+    return json.loads(output.decode("utf-8").strip().splitlines()[-1])
+
+
+def bench_inference_mode(model, device, repeat, batch_size, run_mode=None):
+    if run_mode is None:
+        for mode in ["autograd", "inference"]:
+            result = run_in_subprocess("inference_mode", ["--model", model, "--device", device,
+                                                          "--repeat", str(repeat), "--batch_size", str(batch_size),
+                                                          "--run_mode", mode])
+            print(f"{mode:>10}: load RSS {result['load_rss_mb']:.0f} MB, peak RSS {result['peak_rss_mb']:.0f} MB, "
+                  f"mean {result['mean_ms']:.1f} ms, p50 {result['p50_ms']:.1f} ms, max {result['max_ms']:.1f} ms")
+        return
+
+    from NikudModel import load_nikud_model
+
+    nikud_model = load_nikud_model(model, device, inference_mode=run_mode == "inference")
+    load_rss = peak_rss_mb()
+
+    texts = (SAMPLE_TEXTS * batch_size)[:batch_size]
+    nikud_model.predict_multiple(texts)  # warm up
+    result = time_calls(lambda: nikud_model.predict_multiple(texts), repeat)
+    result.update({"load_rss_mb": load_rss, "peak_rss_mb": peak_rss_mb()})
+    print(json.dumps(result))
+
+
+def bench_quantize(model, repeat, batch_size, run_mode=None):
+    if run_mode is None:
+        results = {}
+        for mode in ["fp32", "int8"]:
+            results[mode] = run_in_subprocess("quantize", ["--model", model, "--repeat", str(repeat),
+                                                           "--batch_size", str(batch_size), "--run_mode", mode])
+            result = results[mode]
+            print(f"{mode:>5}: load {result['load_s']:.1f} s, load RSS {result['load_rss_mb']:.0f} MB, "
+                  f"peak RSS {result['peak_rss_mb']:.0f} MB, mean {result['mean_ms']:.1f} ms, "
+                  f"p50 {result['p50_ms']:.1f} ms, max {result['max_ms']:.1f} ms")
+
+        # the outputs keep the input letters, so comparing them position by position compares the predicted marks
+        fp32_text, int8_text = "".join(results["fp32"]["outputs"]), "".join(results["int8"]["outputs"])
+        same_chars = sum(a == b for a, b in zip(fp32_text, int8_text))
+        print(f"int8 outputs: {same_chars / max(len(fp32_text), len(int8_text)):.2%} of chars identical to fp32, "
+              f"{sum(a == b for a, b in zip(results['fp32']['outputs'], results['int8']['outputs']))}"
+              f"/{len(SAMPLE_TEXTS)} texts identical. Check the accuracy with main.py quantization_report")
+        return
+
+    from NikudModel import load_nikud_model
+
+    start_time = time.perf_counter()
+    nikud_model = load_nikud_model(model, "cpu", quantize=run_mode == "int8")
+    load_time = time.perf_counter() - start_time
+    load_rss = peak_rss_mb()
+
+    texts = (SAMPLE_TEXTS * batch_size)[:batch_size]
+    nikud_model.predict_multiple(texts)  # warm up
+    result = time_calls(lambda: nikud_model.predict_multiple(texts), repeat)
+    result.update({"load_s": load_time, "load_rss_mb": load_rss, "peak_rss_mb": peak_rss_mb(),
+                   "outputs": nikud_model.predict_multiple(SAMPLE_TEXTS)})
+    print(json.dumps(result))
+
+
+def long_document(length, chunk_length):
+    text = " ".join(SAMPLE_TEXTS)
+    text = (text * (length // len(text) + 1))[:length]
+    return [text[start:start + chunk_length] for start in range(0, length, chunk_length)]
+
+
+def legacy_back_2_text(origin_texts, labels):
+    # the char by char decoder NikudDataset.back_2_text used before
+    from src.utiles_data import Nikud
+
+    nikud = Nikud()
+    all_text = ""
+    for indx_sentance, origin in enumerate(origin_texts):
+        new_line = ""
+        for indx_char, c in enumerate(origin):
+            new_line += (c + nikud.id_2_char(labels[indx_sentance, indx_char + 1, 1], "dagesh") +
+                         nikud.id_2_char(labels[indx_sentance, indx_char + 1, 2], "sin") +
+                         nikud.id_2_char(labels[indx_sentance, indx_char + 1, 0], "nikud"))
+        all_text += new_line
+    return all_text
+
+
+def legacy_dicta_decode(config, sentences, offset_mapping, nikud_predictions, shin_predictions):
+    # the offset by offset decoder BertForDiacritization.predict used before
+    from models.Dicta.BertForDiacritization import is_hebrew_letter, is_matres_letter
+
+    ret = []
+    for sent_idx, (sentence, sent_offsets) in enumerate(zip(sentences, offset_mapping)):
+        output = []
+        prev_index = 0
+        for idx, offsets in enumerate(sent_offsets):
+            if offsets[0] > prev_index:
+                output.append(sentence[prev_index:offsets[0]])
+            if offsets[1] - offsets[0] != 1: continue
+
+            char = sentence[offsets[0]:offsets[1]]
+            prev_index = offsets[1]
+            if not is_hebrew_letter(char):
+                output.append(char)
+                continue
+
+            nikud = config.nikud_classes[nikud_predictions[sent_idx][idx]]
+            shin = '' if char != 'ש' else config.shin_classes[shin_predictions[sent_idx][idx]]
+            if nikud == config.mat_lect_token:
+                if not is_matres_letter(char): nikud = ''
+                else: continue
+
+            output.append(char + shin + nikud)
+        output.append(sentence[prev_index:])
+        ret.append(''.join(output))
+    return ret
+
+
+def bench_decode(length, chunk_length, repeat):
+    import numpy as np
+    from transformers import AutoConfig, AutoTokenizer
+
+    from models.Dicta.BertForDiacritization import BertForDiacritization
+    from src.inference import can_have_labels
+    from src.utiles_data import Nikud, labels_2_text
+
+    sentences = long_document(length, chunk_length)
+    rng = np.random.default_rng(0)
+
+    # D-Nikud: random labels where the letters can hold them
+    labels = np.stack([rng.integers(0, size, (len(sentences), chunk_length + 2))
+                       for size in [Nikud.LEN_NIKUD, Nikud.LEN_DAGESH, Nikud.LEN_SIN]], axis=-1)
+    for index, sentence in enumerate(sentences):
+        labels[index, 1:len(sentence) + 1][~can_have_labels(sentence)] = Nikud.PAD_OR_IRRELEVANT
+    legacy = time_calls(lambda: legacy_back_2_text(sentences, labels), repeat)
+    vectorized = time_calls(lambda: "".join(labels_2_text(sentence, labels[index, 1:len(sentence) + 1])
+                                            for index, sentence in enumerate(sentences)), repeat)
+    assert legacy_back_2_text(sentences, labels) == "".join(
+        labels_2_text(sentence, labels[index, 1:len(sentence) + 1]) for index, sentence in enumerate(sentences))
+    print(f"D-Nikud decode of {length} chars: legacy {legacy['mean_ms']:.1f} ms, "
+          f"vectorized {vectorized['mean_ms']:.1f} ms")
+
+    # DictaBERT: the decoder only needs the config, so a one layer model is enough
+    config = AutoConfig.from_pretrained('./models/Dicta', local_files_only=True)
+    config.num_hidden_layers = 1
+    model = BertForDiacritization(config)
+    tokenizer = AutoTokenizer.from_pretrained('./models/Dicta', local_files_only=True)
+    inputs = tokenizer(sentences, padding='longest', return_tensors='np', return_offsets_mapping=True)
+    offset_mapping = inputs['offset_mapping']
+    nikud_predictions = rng.integers(0, len(config.nikud_classes), offset_mapping.shape[:2])
+    shin_predictions = rng.integers(0, len(config.shin_classes), offset_mapping.shape[:2])
+    decode_args = (sentences, offset_mapping, nikud_predictions, shin_predictions)
+    legacy = time_calls(lambda: legacy_dicta_decode(config, *decode_args), repeat)
+    vectorized = time_calls(lambda: model.decode(*decode_args), repeat)
+    assert legacy_dicta_decode(config, *decode_args) == model.decode(*decode_args)
+    print(f"DictaBERT decode of {length} chars: legacy {legacy['mean_ms']:.1f} ms, "
+          f"vectorized {vectorized['mean_ms']:.1f} ms")
+
+
+def legacy_text_contains_nikud(text):
+    from src.utiles_data import Nikud
+
+    return len(set(text) & Nikud.all_nikud_chr) > 0
+
+
+def legacy_combine_sentences(list_sentences, max_length=0, is_train=False):
+    # the combine_sentences NikudDataset.split_text used before, which rebuilds the list for every long line
+    unique_key = "\x00split\x00"
+    all_new_sentences = []
+    new_sen = ""
+    index = 0
+    while index < len(list_sentences):
+        sen = list_sentences[index]
+
+        if not legacy_text_contains_nikud(sen) and ('------------------' in sen or sen == '\n'):
+            if len(new_sen) > 0:
+                all_new_sentences.append(new_sen)
+                if not is_train:
+                    all_new_sentences.append(sen)
+                new_sen = ""
+                index += 1
+                continue
+
+        if not legacy_text_contains_nikud(sen) and is_train:
+            index += 1
+            continue
+
+        if len(sen) > max_length:
+            update_sen = sen.replace(". ", f". {unique_key}")
+            update_sen = update_sen.replace("? ", f"? {unique_key}")
+            update_sen = update_sen.replace("! ", f"! {unique_key}")
+            update_sen = update_sen.replace("” ", f"” {unique_key}")
+            update_sen = update_sen.replace("\t", f"\t{unique_key}")
+            part_sentence = update_sen.split(unique_key)
+
+            good_parts = []
+            for p in part_sentence:
+                if len(p) < max_length:
+                    good_parts.append(p)
+                else:
+                    prev = 0
+                    while prev <= len(p):
+                        part = p[prev:(prev + max_length)]
+                        last_space = 0
+                        if " " in part:
+                            last_space = part[::-1].index(" ") + 1
+                        next = prev + max_length - last_space
+                        part = p[prev:next]
+                        good_parts.append(part)
+                        prev = next
+            list_sentences = list_sentences[:index] + good_parts + list_sentences[index + 1:]
+            continue
+        if new_sen == "":
+            new_sen = sen
+        elif len(new_sen) + len(sen) < max_length:
+            new_sen += sen
+        else:
+            all_new_sentences.append(new_sen)
+            new_sen = sen
+
+        index += 1
+    if len(new_sen) > 0:
+        all_new_sentences.append(new_sen)
+    return all_new_sentences
+
+
+def legacy_split_text(file_data, max_length, is_train=False):
+    unique_key = "\x00split\x00"
+    file_data = file_data.replace("\n", f"\n{unique_key}")
+    return legacy_combine_sentences(file_data.split(unique_key), is_train=is_train, max_length=max_length)
+
+
+def synthetic_corpus(rng, num_lines):
+    # lines of all the kinds split_text treats differently: short and long, with and without nikud and sentence
+    # ends, tabs, runs without spaces, blank lines and separators
+    from src.utiles_data import Nikud
+
+    nikud = sorted(Nikud.all_nikud_chr)
+    words = ["שלום", "עולם", "של", "בית", "ספר", "ילד", "1948", "abc"]
+    punctuation = ["", "", "", ". ", "? ", "! ", "” ", "\t", ", "]
+    lines = []
+    for _ in range(num_lines):
+        kind = rng.random()
+        if kind < 0.1:
+            lines.append("\n")
+        elif kind < 0.13:
+            lines.append("------------------\n")
+        elif kind < 0.15:
+            lines.append("א" * int(rng.integers(1, 400)) + "\n")
+        else:
+            line = []
+            for _ in range(int(rng.integers(1, 120 if kind < 0.3 else 25))):
+                word = words[int(rng.integers(len(words)))]
+                if rng.random() < 0.5:
+                    word = "".join(c + nikud[int(rng.integers(len(nikud)))] for c in word)
+                line.append(word + (punctuation[int(rng.integers(len(punctuation)))] or " "))
+            lines.append("".join(line).rstrip(" ") + "\n")
+    # the last line doesn't always end with a newline
+    return "".join(lines)[:-1] if rng.random() < 0.5 else "".join(lines)
+
+
+def bench_segment(num_lines, repeat, num_checks):
+    import numpy as np
+
+    from src.running_params import MAX_LENGTH_SEN
+    from src.utiles_data import combine_sentences, split_lines
+
+    # property check: the single pass segmenter splits random corpora exactly like the legacy one
+    rng = np.random.default_rng(0)
+    for _ in range(num_checks):
+        text = synthetic_corpus(rng, int(rng.integers(0, 60)))
+        # short max lengths still leave a space in every cut, where the legacy segmenter never ends otherwise
+        for max_length in [16, 40, MAX_LENGTH_SEN]:
+            for is_train in [False, True]:
+                expected = legacy_split_text(text, max_length, is_train=is_train)
+                segmented = combine_sentences(split_lines(text), max_length=max_length, is_train=is_train)
+                assert segmented == expected, (text, max_length, is_train)
+    print(f"{num_checks} random corpora segmented like the legacy segmenter")
+
+    text = synthetic_corpus(rng, num_lines)
+    legacy = time_calls(lambda: legacy_split_text(text, MAX_LENGTH_SEN), repeat)
+    single_pass = time_calls(lambda: combine_sentences(split_lines(text), max_length=MAX_LENGTH_SEN), repeat)
+    print(f"Segmenting {num_lines} lines ({len(text)} chars): legacy {legacy['mean_ms']:.1f} ms, "
+          f"single pass {single_pass['mean_ms']:.1f} ms")
+
+
+def legacy_read_data_list(data_list):
+    # the Letter per char parser NikudDataset.read_data_list used before
+    from src.utiles_data import Letter, Letters, Nikud
+
+    data = []
+    orig_data = []
+    for sen in data_list:
+        if sen == "":
+            continue
+
+        labels = []
+        text = ""
+        text_org = ""
+        index = 0
+        sentence_length = len(sen)
+        while index < sentence_length:
+            if ord(sen[index]) == Nikud.nikud_dict['PUNCTUATION MAQAF'] or ord(sen[index]) == Nikud.nikud_dict[
+                'PUNCTUATION PASEQ'] or ord(sen[index]) == Nikud.nikud_dict['METEG']:
+                index += 1
+                continue
+
+            label = []
+            l = Letter(sen[index])
+            if not ( l.letter not in Nikud.all_nikud_chr):
+                if sen[index-1] == '\n':
+                    index += 1
+                    continue
+            assert l.letter not in Nikud.all_nikud_chr
+            if sen[index] in Letters.hebrew:
+                index += 1
+                while index < sentence_length and ord(sen[index]) in Nikud.all_nikud_ord:
+                    label.append(ord(sen[index]))
+                    index += 1
+            else:
+                index += 1
+
+            l.get_label_letter(label)
+            text += l.normalized
+            text_org += l.letter
+            labels.append(l)
+
+        data.append((text, labels))
+        orig_data.append(text_org)
+
+    return data, orig_data
+
+
+def synthetic_diacritized(rng, length, max_nikud=6):
+    # random Hebrew letters with random runs of up to max_nikud diacritics, including the combinations get_label_letter treats
+    # specially, and other chars, newlines followed by stray diacritics and stray maqafs and metegs
+    from src.utiles_data import Letters, Nikud
+
+    nikud = sorted(Nikud.all_nikud_ord)
+    special = [[Nikud.nikud_dict['SHIN_YEMANIT'], Nikud.DAGESH_LETTER, Nikud.nikud_dict['KAMATZ']],
+               [Nikud.nikud_dict['SHIN_SMALIT'], Nikud.DAGESH_LETTER], [Nikud.DAGESH_LETTER],
+               [Nikud.nikud_dict['HOLAM']], [Nikud.nikud_dict['KAMATZ_KATAN'], Nikud.nikud_dict['METEG']],
+               [Nikud.nikud_dict['METEG'], Nikud.nikud_dict['METEG'], Nikud.nikud_dict['PATAKH']]]
+    others = list(" .,?!-\t1234567890abc\"'״…—") + ["ײ", "\u200f"]
+    chars = []
+    for _ in range(length):
+        kind = rng.random()
+        if kind < 0.7:
+            chars.append(Letters.hebrew[int(rng.integers(len(Letters.hebrew)))])
+            if rng.random() < 0.2:
+                chars.append("".join(map(chr, special[int(rng.integers(len(special)))])))
+            else:
+                num_nikud = int(rng.integers(0, max_nikud + 1))
+                chars.append("".join(chr(nikud[i]) for i in rng.integers(0, len(nikud), num_nikud)))
+        elif kind < 0.97:
+            chars.append(others[int(rng.integers(len(others)))])
+        elif kind < 0.99:
+            chars.append("\n" + chr(nikud[int(rng.integers(len(nikud)))]))
+        else:
+            chars.append(" " + chr(Nikud.nikud_dict['PUNCTUATION MAQAF']) + chr(Nikud.nikud_dict['METEG']))
+    return "".join(chars)
+
+
+def bench_labels(num_sentences, sentence_length, repeat, num_checks):
+    import numpy as np
+
+    from src.utiles_data import parse_diacritized
+
+    def parse(sentences):
+        return [parse_diacritized(sentence) for sentence in sentences]
+
+    # parity check: the same text, original letters and labels as the Letter per char parser
+    rng = np.random.default_rng(0)
+    for _ in range(num_checks):
+        sentence = synthetic_diacritized(rng, int(rng.integers(0, 200)))
+        try:
+            data, orig_data = legacy_read_data_list([sentence])
+        except (AssertionError, KeyError, ValueError) as e:
+            # a diacritic the legacy parser can't read, e.g. a shin dot in the third place, fails both ways
+            try:
+                parse_diacritized(sentence)
+            except (KeyError, ValueError):
+                continue
+            raise AssertionError(f"{sentence!r} only fails the legacy parser: {e!r}")
+        if not data:
+            continue
+        text, text_org, labels = parse_diacritized(sentence)
+        (expected_text, letters), = data
+        assert text == expected_text and text_org == orig_data[0], sentence
+        assert labels.tolist() == [[l.nikud, l.dagesh, l.sin] for l in letters], sentence
+    print(f"{num_checks} random sentences parsed like the Letter parser")
+
+    # up to one random diacritic per letter besides the special combinations, which the legacy parser reads
+    sentences = [synthetic_diacritized(rng, sentence_length, max_nikud=1) for _ in range(num_sentences)]
+    legacy = time_calls(lambda: legacy_read_data_list(sentences), repeat)
+    vectorized = time_calls(lambda: parse(sentences), repeat)
+    num_chars = sum(len(sentence) for sentence in sentences)
+    print(f"Parsing {len(sentences)} sentences ({num_chars} chars): legacy {legacy['mean_ms']:.1f} ms, "
+          f"vectorized {vectorized['mean_ms']:.1f} ms")
+
+
+def bench_imports(modules, run_mode=None):
+    if run_mode is None:
+        for module in modules:
+            results = {mode: run_in_subprocess("imports", ["--modules", module, "--run_mode", mode])
+                       for mode in ["eager", "lazy"]}
+            eager, lazy = results["eager"], results["lazy"]
+            print(f"{module}: {lazy['import_s']:.2f} s and {lazy['rss_mb']:.0f} MB RSS, "
+                  f"{eager['import_s']:.2f} s and {eager['rss_mb']:.0f} MB with the training modules imported "
+                  f"up front. Loaded anyway: {', '.join(lazy['heavy_modules']) or 'none'}")
+        return
+
+    start_time = time.perf_counter()
+    if run_mode == "eager":
+        # what importing the serving path used to cost
+        for heavy_module in HEAVY_MODULES:
+            importlib.import_module(heavy_module)
+    importlib.import_module(modules[0])
+    import_time = time.perf_counter() - start_time
+
+    # a module imported on the way by a dependency, e.g. transformers, is reported too
+    heavy_modules = [heavy_module for heavy_module in HEAVY_MODULES if heavy_module in sys.modules]
+    print(json.dumps({"import_s": import_time, "rss_mb": peak_rss_mb(), "heavy_modules": heavy_modules}))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description="""Nikud serving benchmarks""")
+    subparsers = parser.add_subparsers(help='sub-command help', dest='command', required=True)
+
+    parser_inference_mode = subparsers.add_parser('inference_mode',
+                                                  help='compare latency and peak RSS with and without autograd')
+    parser_inference_mode.add_argument('--model', choices=["dnikud", "dicta"], default="dicta")
+    parser_inference_mode.add_argument('--device', default="cpu")
+    parser_inference_mode.add_argument('--repeat', type=int, default=20, help='number of timed calls')
+    parser_inference_mode.add_argument('--batch_size', type=int, default=8, help='number of texts per call')
+    parser_inference_mode.add_argument('--run_mode', choices=["autograd", "inference"], default=None,
+                                       help=argparse.SUPPRESS)
+    parser_inference_mode.set_defaults(func=bench_inference_mode)
+
+    parser_quantize = subparsers.add_parser('quantize',
+                                            help='compare load time, latency, peak RSS and outputs of fp32 and int8')
+    parser_quantize.add_argument('--model', choices=["dnikud", "dicta"], default="dicta")
+    parser_quantize.add_argument('--repeat', type=int, default=20, help='number of timed calls')
+    parser_quantize.add_argument('--batch_size', type=int, default=8, help='number of texts per call')
+    parser_quantize.add_argument('--run_mode', choices=["fp32", "int8"], default=None, help=argparse.SUPPRESS)
+    parser_quantize.set_defaults(func=bench_quantize)
+
+    parser_decode = subparsers.add_parser('decode', help='compare the char by char and the vectorized decoders')
+    parser_decode.add_argument('--length', type=int, default=200000, help='document length in chars')
+    parser_decode.add_argument('--chunk_length', type=int, default=1000, help='sentence length in chars')
+    parser_decode.add_argument('--repeat', type=int, default=5, help='number of timed calls')
+    parser_decode.set_defaults(func=bench_decode)
+
+    parser_segment = subparsers.add_parser('segment', help='check and compare the legacy and the single pass '
+                                                           'sentence segmenters')
+    parser_segment.add_argument('--num_lines', type=int, default=100000, help='corpus length in lines')
+    parser_segment.add_argument('--repeat', type=int, default=3, help='number of timed calls')
+    parser_segment.add_argument('--num_checks', type=int, default=300, help='number of random corpora checked')
+    parser_segment.set_defaults(func=bench_segment)
+
+    parser_labels = subparsers.add_parser('labels', help='check and compare the Letter per char and the vectorized '
+                                                         'diacritized text parsers')
+    parser_labels.add_argument('--num_sentences', type=int, default=2000, help='number of timed sentences')
+    parser_labels.add_argument('--sentence_length', type=int, default=500, help='sentence length in letters')
+    parser_labels.add_argument('--repeat', type=int, default=3, help='number of timed calls')
+    parser_labels.add_argument('--num_checks', type=int, default=3000, help='number of random sentences checked')
+    parser_labels.set_defaults(func=bench_labels)
+
+    parser_imports = subparsers.add_parser('imports', help='compare import time and RSS of the entry points with '
+                                                           'and without the training modules imported')
+    parser_imports.add_argument('--modules', nargs='+',
+                                default=["Nikud_server", "asgi_server", "prefork_server", "main"],
+                                help='modules to import')
+    parser_imports.add_argument('--run_mode', choices=["eager", "lazy"], default=None, help=argparse.SUPPRESS)
+    parser_imports.set_defaults(func=bench_imports)
+
+    args = parser.parse_args()
+    kwargs = vars(args).copy()
+    del kwargs['command']
+    del kwargs['func']
+    args.func(**kwargs)
@@ -1,5 +1,8 @@
 # general
 import argparse
+import copy
+import json
+import multiprocessing
 import os
 import sys
 import time
@@ -11,20 +14,36 @@ from pathlib import Path
 # ML
 import torch
 import torch.nn as nn
-from transformers import AutoConfig, AutoTokenizer
+from transformers import AutoConfig
 
 # DL
-from src.models import DNikudModel, ModelConfig
+from NikudModel import MODEL_PATHS, load_nikud_model
+from model_store import check_model_store
+from model_export import DictaBERTGraph, DNikudGraph, export_graph
+from sample_texts import SAMPLE_TEXTS
+from src.char_tokenizer import load_tavbert_tokenizer
+from src.feature_store import create_feature_data_loader, open_feature_store
+from src.inference import DNikudInferencePipeline
+from src.models import DNikudModel, ModelConfig, quantize_dynamic
 from src.models_utils import training, evaluate, predict
 from src.plot_helpers import generate_plot_by_nikud_dagesh_sin_dict, \
     generate_word_and_letter_accuracy_plot
 from src.running_params import BATCH_SIZE, MAX_LENGTH_SEN
-from src.utiles_data import NikudDataset, Nikud, create_missing_folders, \
-    extract_text_to_compare_nakdimon
+from src.utiles_data import NikudDataset, Nikud, create_missing_folders, create_data_loader, restore_order, \
+    extract_text_to_compare_nakdimon, read_sentence_blocks, IterableNikudDataset, create_training_data_loader
 
 DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
 # assert DEVICE == 'cuda'
 
+# about how many chars of whole sentences a streaming prediction holds in memory at once
+MAX_BLOCK_CHARS = 1000000
+# the D-Nikud tokenizer bundle saved by prepare_store
+TOKENIZER_FOLDER = os.path.join("models", "Dnikud", "tokenizer")
+# lists the files predict_parallel completed, one json object per line
+PREDICT_MANIFEST_FILE = "predict_manifest.jsonl"
+# how often predict_parallel logs its progress, in seconds
+PROGRESS_INTERVAL = 30
+
 
 def get_logger(log_level, name_func, date_time=datetime.now().strftime('%d_%m_%y__%H_%M')):
     log_location = os.path.join(os.path.join(Path(__file__).parent, "logging"), f"log_model_{name_func}_{date_time}")
@@ -57,21 +76,41 @@ def get_logger(log_level, name_func, date_time=datetime.now().strftime('%d_%m_%y
     return logger
 
 
-def evaluate_text(path, dnikud_model, tokenizer_tavbert, logger, plots_folder=None, batch_size=BATCH_SIZE):
-    path_name = os.path.basename(path)
+def load_trained_model(pretrain_model_path):
+    dir_model_config = os.path.join("models", "config.yml")
+    config = ModelConfig.load_from_file(dir_model_config)
+
+    dnikud_model = DNikudModel(config, len(Nikud.label_2_id["nikud"]), len(Nikud.label_2_id["dagesh"]),
+                               len(Nikud.label_2_id["sin"]), device=DEVICE).to(DEVICE)
+    state_dict_model = dnikud_model.state_dict()
+    state_dict_model.update(torch.load(pretrain_model_path, map_location=DEVICE))
+    dnikud_model.load_state_dict(state_dict_model)
+    # predict and evaluate run it without dropout, training switches it back to train mode every epoch
+    return dnikud_model.eval()
 
-    msg = f"evaluate text: {path_name} on D-nikud Model"
-    logger.debug(msg)
 
+def create_evaluate_data_loader(path, tokenizer_tavbert, logger, batch_size=BATCH_SIZE, cache_folder=None):
     if os.path.isfile(path):
-        dataset = NikudDataset(tokenizer_tavbert, file=path, logger=logger, max_length=MAX_LENGTH_SEN)
+        dataset = NikudDataset(tokenizer_tavbert, file=path, logger=logger, max_length=MAX_LENGTH_SEN,
+                               cache_folder=cache_folder)
     elif os.path.isdir(path):
-        dataset = NikudDataset(tokenizer_tavbert, folder=path, logger=logger, max_length=MAX_LENGTH_SEN)
+        dataset = NikudDataset(tokenizer_tavbert, folder=path, logger=logger, max_length=MAX_LENGTH_SEN,
+                               cache_folder=cache_folder)
     else:
         raise Exception("input path doesnt exist")
 
     dataset.prepare_data(name="evaluate")
-    mtb_dl = torch.utils.data.DataLoader(dataset.prepered_data, batch_size=batch_size)
+    return torch.utils.data.DataLoader(dataset.prepered_data, batch_size=batch_size)
+
+
+def evaluate_text(path, dnikud_model, tokenizer_tavbert, logger, plots_folder=None, batch_size=BATCH_SIZE,
+                  cache_folder=None):
+    path_name = os.path.basename(path)
+
+    msg = f"evaluate text: {path_name} on D-nikud Model"
+    logger.debug(msg)
+
+    mtb_dl = create_evaluate_data_loader(path, tokenizer_tavbert, logger, batch_size, cache_folder)
 
     word_level_correct, letter_level_correct_dev = evaluate(dnikud_model, mtb_dl, plots_folder, device=DEVICE)
 
@@ -80,15 +119,26 @@ def evaluate_text(path, dnikud_model, tokenizer_tavbert, logger, plots_folder=No
     logger.debug(msg)
 
 
-def predict_text(text_file, tokenizer_tavbert, output_file, logger, dnikud_model, compare_nakdimon=False):
+def predict_text(text_file, tokenizer_tavbert, output_file, logger, dnikud_model, compare_nakdimon=False,
+                 padding="max_length", bucketing=False, stream=False, max_block_chars=MAX_BLOCK_CHARS):
+    if stream:
+        start_time = time.time()
+        num_chars = stream_predict_text(text_file, tokenizer_tavbert, output_file, logger, dnikud_model,
+                                        compare_nakdimon=compare_nakdimon, padding=padding, bucketing=bucketing,
+                                        max_block_chars=max_block_chars)
+        elapsed_time = time.time() - start_time
+        print(f"Execution time: {elapsed_time:.6f} seconds, {num_chars / max(elapsed_time, 1e-9):.0f} chars/sec")
+        return
+
     dataset = NikudDataset(tokenizer_tavbert, file=text_file, logger=logger, max_length=MAX_LENGTH_SEN)
 
     # Start time
     start_time = time.time()
 
-    dataset.prepare_data(name="prediction")
-    mtb_prediction_dl = torch.utils.data.DataLoader(dataset.prepered_data, batch_size=BATCH_SIZE)
-    all_labels = predict(dnikud_model, mtb_prediction_dl, DEVICE)
+    dataset.prepare_data(name="prediction", padding=padding)
+    mtb_prediction_dl, order = create_data_loader(dataset.prepered_data, BATCH_SIZE, padding=padding,
+                                                  bucketing=bucketing, pad_token_id=tokenizer_tavbert.pad_token_id)
+    all_labels = restore_order(predict(dnikud_model, mtb_prediction_dl, DEVICE), order)
     text_data_with_labels = dataset.back_2_text(labels=all_labels)
 
     # End time
@@ -109,7 +159,37 @@ def predict_text(text_file, tokenizer_tavbert, output_file, logger, dnikud_model
                 f.write(text_data_with_labels)
 
 
-def predict_folder(folder, output_folder, logger, tokenizer_tavbert, dnikud_model, compare_nakdimon=False):
+def stream_predict_text(text_file, tokenizer_tavbert, output_file, logger, dnikud_model, compare_nakdimon=False,
+                        padding="max_length", bucketing=False, max_block_chars=MAX_BLOCK_CHARS):
+    """
+    Predicts the file block by block (see read_sentence_blocks) and appends each block's output to the output file
+    as soon as it's done, so memory stays bounded by the block size whatever the size of the file.
+    Returns the number of chars of the file.
+    """
+    msg = f"stream predict file: {text_file}"
+    logger.debug(msg)
+
+    pipeline = DNikudInferencePipeline(dnikud_model, tokenizer_tavbert, device=DEVICE, padding=padding,
+                                       bucketing=bucketing)
+
+    num_chars = 0
+    f = sys.stdout if output_file is None else open(output_file, "w", encoding='utf-8')
+    try:
+        for block in read_sentence_blocks(text_file, max_block_chars):
+            text_data_with_labels = "".join(pipeline.predict(block))
+            if compare_nakdimon:
+                text_data_with_labels = extract_text_to_compare_nakdimon(text_data_with_labels)
+            f.write(text_data_with_labels)
+            f.flush()
+            num_chars += sum(len(sentence) for sentence in block)
+    finally:
+        if output_file is not None:
+            f.close()
+    return num_chars
+
+
+def predict_folder(folder, output_folder, logger, tokenizer_tavbert, dnikud_model, compare_nakdimon=False,
+                   padding="max_length", bucketing=False, stream=False, max_block_chars=MAX_BLOCK_CHARS):
     create_missing_folders(output_folder)
 
     for filename in os.listdir(folder):
@@ -121,12 +201,126 @@ def predict_folder(folder, output_folder, logger, tokenizer_tavbert, dnikud_mode
                          output_file=output_file,
                          logger=logger,
                          tokenizer_tavbert=tokenizer_tavbert,
-                         dnikud_model=dnikud_model, compare_nakdimon=compare_nakdimon)
+                         dnikud_model=dnikud_model, compare_nakdimon=compare_nakdimon,
+                         padding=padding, bucketing=bucketing, stream=stream, max_block_chars=max_block_chars)
         elif os.path.isdir(file_path) and filename != ".git" and filename != "README.md":
             sub_folder = file_path
             sub_folder_output = os.path.join(output_folder, filename)
             predict_folder(sub_folder, sub_folder_output, logger, tokenizer_tavbert, dnikud_model,
-                           compare_nakdimon=compare_nakdimon)
+                           compare_nakdimon=compare_nakdimon, padding=padding, bucketing=bucketing, stream=stream,
+                           max_block_chars=max_block_chars)
+
+
+def list_text_files(folder):
+    # the .txt files predict_folder predicts, as paths relative to the folder
+    for root, dirs, files in os.walk(folder, followlinks=True):
+        dirs[:] = sorted(name for name in dirs if name != ".git" and name != "README.md")
+        for filename in sorted(files):
+            if filename.lower().endswith('.txt'):
+                yield os.path.relpath(os.path.join(root, filename), folder)
+
+
+def read_predict_manifest(manifest_path):
+    completed = set()
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r", encoding='utf-8') as f:
+            lines = f.read().split("\n")
+        for line in lines:
+            # a line cut short by an interruption is ignored, its file is predicted again
+            try:
+                completed.add(json.loads(line)["file"])
+            except (ValueError, KeyError):
+                continue
+        if lines[-1] != "":
+            # end the cut line, so the next entry starts on a line of its own
+            with open(manifest_path, "a", encoding='utf-8') as f:
+                f.write("\n")
+    return completed
+
+
+_predict_worker = {}
+
+
+def init_predict_worker(pretrain_model_path, num_threads, padding, bucketing, compare_nakdimon, max_block_chars):
+    # each worker holds its own model and runs it on its share of the cores
+    torch.set_num_threads(num_threads)
+    _predict_worker.update(tokenizer_tavbert=load_tavbert_tokenizer(TOKENIZER_FOLDER, char_level=True),
+                           dnikud_model=load_trained_model(pretrain_model_path),
+                           padding=padding, bucketing=bucketing, compare_nakdimon=compare_nakdimon,
+                           max_block_chars=max_block_chars)
+
+
+def predict_file_in_worker(task):
+    relative_path, input_file, output_file = task
+    start_time = time.time()
+    # written under a temporary name first, so an interrupted run never leaves a partial output behind
+    partial_output_file = f"{output_file}.partial"
+    try:
+        create_missing_folders(os.path.dirname(output_file))
+        num_chars = stream_predict_text(input_file, output_file=partial_output_file,
+                                        logger=logging.getLogger("algo"), **_predict_worker)
+        os.replace(partial_output_file, output_file)
+    except Exception as e:
+        if os.path.exists(partial_output_file):
+            os.remove(partial_output_file)
+        return relative_path, None, f"{type(e).__name__}: {e}"
+    return relative_path, num_chars, time.time() - start_time
+
+
+def do_predict_parallel(input_path, output_path, pretrain_model_path, workers, threads_per_worker, logger,
+                        tokenizer_tavbert, dnikud_model, compare_nakdimon=False, padding="max_length",
+                        bucketing=False, max_block_chars=MAX_BLOCK_CHARS):
+    if not os.path.isdir(input_path):
+        raise Exception("input path must be a folder")
+    create_missing_folders(output_path)
+
+    manifest_path = os.path.join(output_path, PREDICT_MANIFEST_FILE)
+    completed = read_predict_manifest(manifest_path)
+    files = [relative_path for relative_path in list_text_files(input_path) if relative_path not in completed]
+    # the largest files first, so a big file picked up last doesn't keep a single worker busy at the end
+    files.sort(key=lambda relative_path: os.path.getsize(os.path.join(input_path, relative_path)), reverse=True)
+    tasks = [(relative_path, os.path.join(input_path, relative_path), os.path.join(output_path, relative_path))
+             for relative_path in files]
+
+    num_threads = threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+    msg = f'predicting {len(tasks)} files with {workers} workers of {num_threads} threads, ' \
+          f'{len(completed)} files already completed'
+    logger.info(msg)
+
+    start_time = time.time()
+    last_progress_time = start_time
+    num_chars = 0
+    num_done = 0
+    failed = []
+    # spawned workers start from a clean interpreter, without the torch thread pools of this process
+    context = multiprocessing.get_context("spawn")
+    init_args = (pretrain_model_path, num_threads, padding, bucketing, compare_nakdimon, max_block_chars)
+    with context.Pool(workers, initializer=init_predict_worker, initargs=init_args) as pool, \
+            open(manifest_path, "a", encoding='utf-8') as manifest:
+        for relative_path, file_chars, result in pool.imap_unordered(predict_file_in_worker, tasks):
+            if file_chars is None:
+                failed.append(relative_path)
+                msg = f'failed to predict {relative_path}: {result}'
+                logger.error(msg)
+                continue
+
+            manifest.write(json.dumps({"file": relative_path, "chars": file_chars, "seconds": round(result, 3)},
+                                      ensure_ascii=False) + "\n")
+            manifest.flush()
+            num_chars += file_chars
+            num_done += 1
+
+            if time.time() - last_progress_time >= PROGRESS_INTERVAL:
+                last_progress_time = time.time()
+                msg = f'{num_done}/{len(tasks)} files, {num_chars / (last_progress_time - start_time):.0f} chars/sec'
+                logger.info(msg)
+
+    elapsed_time = time.time() - start_time
+    msg = f'predicted {num_done} files, {num_chars} chars in {elapsed_time:.1f} seconds: ' \
+          f'{num_chars / max(elapsed_time, 1e-9):.0f} chars/sec with {workers} workers, {len(failed)} failed'
+    logger.info(msg)
+    if failed:
+        raise Exception(f"{len(failed)} files failed, run the command again to retry them")
 
 
 def update_compare_folder(folder, output_folder):
@@ -160,21 +354,24 @@ def check_files_excepted(folder):
             check_files_excepted(file_path)
 
 
-def do_predict(input_path, output_path, tokenizer_tavbert, logger, dnikud_model, compare_nakdimon):
+def do_predict(input_path, output_path, tokenizer_tavbert, logger, dnikud_model, compare_nakdimon,
+               padding="max_length", bucketing=False, stream=False, max_block_chars=MAX_BLOCK_CHARS):
     if os.path.isdir(input_path):
         predict_folder(input_path, output_path, logger, tokenizer_tavbert, dnikud_model,
-                       compare_nakdimon=compare_nakdimon)
+                       compare_nakdimon=compare_nakdimon, padding=padding, bucketing=bucketing, stream=stream,
+                       max_block_chars=max_block_chars)
     elif os.path.isfile(input_path):
         predict_text(input_path,
                      output_file=output_path,
                      logger=logger,
                      tokenizer_tavbert=tokenizer_tavbert,
-                     dnikud_model=dnikud_model, compare_nakdimon=compare_nakdimon)
+                     dnikud_model=dnikud_model, compare_nakdimon=compare_nakdimon,
+                     padding=padding, bucketing=bucketing, stream=stream, max_block_chars=max_block_chars)
     else:
         raise Exception("Input file not exist")
 
 
-def evaluate_folder(folder_path, logger, dnikud_model, tokenizer_tavbert, plots_folder):
+def evaluate_folder(folder_path, logger, dnikud_model, tokenizer_tavbert, plots_folder, cache_folder=None):
     msg = f'evaluate sub folder: {folder_path}'
     logger.info(msg)
 
@@ -183,7 +380,8 @@ def evaluate_folder(folder_path, logger, dnikud_model, tokenizer_tavbert, plots_
                   tokenizer_tavbert=tokenizer_tavbert,
                   logger=logger,
                   plots_folder=plots_folder,
-                  batch_size=BATCH_SIZE)
+                  batch_size=BATCH_SIZE,
+                  cache_folder=cache_folder)
 
     msg = f'\n***************************************\n'
     logger.info(msg)
@@ -197,10 +395,11 @@ def evaluate_folder(folder_path, logger, dnikud_model, tokenizer_tavbert, plots_
                 or "NakdanResults" in sub_folder_path):
             continue
 
-        evaluate_folder(sub_folder_path, logger, dnikud_model, tokenizer_tavbert, plots_folder)
+        evaluate_folder(sub_folder_path, logger, dnikud_model, tokenizer_tavbert, plots_folder, cache_folder)
 
 
-def do_evaluate(input_path, logger, dnikud_model, tokenizer_tavbert, plots_folder, eval_sub_folders=False):
+def do_evaluate(input_path, logger, dnikud_model, tokenizer_tavbert, plots_folder, eval_sub_folders=False,
+                cache_folder=None):
     msg = f'evaluate all_data: {input_path}'
     logger.info(msg)
 
@@ -209,7 +408,8 @@ def do_evaluate(input_path, logger, dnikud_model, tokenizer_tavbert, plots_folde
                   tokenizer_tavbert=tokenizer_tavbert,
                   logger=logger,
                   plots_folder=plots_folder,
-                  batch_size=BATCH_SIZE)
+                  batch_size=BATCH_SIZE,
+                  cache_folder=cache_folder)
 
     msg = f'\n\n~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~\n\n'
     logger.info(msg)
@@ -224,49 +424,201 @@ def do_evaluate(input_path, logger, dnikud_model, tokenizer_tavbert, plots_folde
                     or "NakdanResults" in sub_folder_path):
                 continue
 
-            evaluate_folder(sub_folder_path, logger, dnikud_model, tokenizer_tavbert, plots_folder)
+            evaluate_folder(sub_folder_path, logger, dnikud_model, tokenizer_tavbert, plots_folder, cache_folder)
+
+
+def do_quantization_report(input_path, logger, dnikud_model, tokenizer_tavbert, plots_folder):
+    msg = f'quantization report: {input_path}'
+    logger.info(msg)
+
+    mtb_dl = create_evaluate_data_loader(input_path, tokenizer_tavbert, logger)
+
+    # quantized kernels only run on CPU, so both models are evaluated there for comparable timings
+    dnikud_model = dnikud_model.cpu()
+    models = {"fp32": dnikud_model, "int8": quantize_dynamic(copy.deepcopy(dnikud_model))}
+
+    results = {}
+    for name, model in models.items():
+        model_plots_folder = os.path.join(plots_folder, f"quantization_{name}")
+        create_missing_folders(model_plots_folder)
+
+        start_time = time.time()
+        word_level_correct, letter_level_correct = evaluate(model, mtb_dl, model_plots_folder, device='cpu')
+        results[name] = (float(letter_level_correct), float(word_level_correct), time.time() - start_time)
+
+    msg = "Quantization report\n" + "\n".join(
+        f"{name}: letter level accuracy {letter:.4f}, word level accuracy {word:.4f}, evaluation time {seconds:.1f}s"
+        for name, (letter, word, seconds) in results.items())
+    fp32_letter, fp32_word, fp32_seconds = results["fp32"]
+    int8_letter, int8_word, int8_seconds = results["int8"]
+    msg += f"\nint8 vs fp32: letter accuracy {int8_letter - fp32_letter:+.4f}, " \
+           f"word accuracy {int8_word - fp32_word:+.4f}, speedup x{fp32_seconds / int8_seconds:.2f}"
+    logger.info(msg)
+
+
+def do_export(model, export_format, corpus_path, min_identical_chars, logger, tokenizer_tavbert, dnikud_model):
+    # exports the model of the server, to the path its exported backend loads from
+    eager_model = load_nikud_model(model, 'cpu')
+    output_path = eager_model.exported_path(export_format)
+
+    if corpus_path is None:
+        texts = SAMPLE_TEXTS
+    else:
+        with open(corpus_path, "r", encoding='utf-8') as f:
+            texts = [line for line in f.read().splitlines() if line.strip()]
+
+    example_texts = [eager_model.normalize(text) for text in texts[:2]]
+    if model == "dnikud":
+        input_ids, attention_mask, _ = eager_model.pipeline.encode(example_texts)
+        graph = DNikudGraph(eager_model.dnikud_model)
+    else:
+        inputs = eager_model.tokenizer(example_texts, padding='longest', truncation=True, return_tensors='pt')
+        input_ids, attention_mask = inputs['input_ids'], inputs['attention_mask']
+        graph = DictaBERTGraph(eager_model.model)
+
+    msg = f'exporting {model} to {output_path}'
+    logger.info(msg)
+    export_graph(graph, (input_ids, attention_mask), output_path, export_format)
+
+    # parity check: the exported model must diacritize the corpus like the eager one
+    exported_model = load_nikud_model(model, 'cpu', backend=export_format)
+    for nikud_model in [eager_model, exported_model]:
+        nikud_model.predict_multiple(texts[:1])  # warm up
+    start_time = time.time()
+    expected = eager_model.predict_multiple(texts)
+    eager_time = time.time() - start_time
+    start_time = time.time()
+    outputs = exported_model.predict_multiple(texts)
+    exported_time = time.time() - start_time
+
+    identical_texts = sum(output == expected_output for output, expected_output in zip(outputs, expected))
+    expected_text, output_text = "".join(expected), "".join(outputs)
+    identical_chars = sum(a == b for a, b in zip(expected_text, output_text)) / max(len(expected_text),
+                                                                                    len(output_text), 1)
+    msg = f'{export_format} vs eager on {len(texts)} texts: {identical_texts} texts and {identical_chars:.4%} of ' \
+          f'chars identical, eager {eager_time:.2f}s, {export_format} {exported_time:.2f}s'
+    logger.info(msg)
+
+    if identical_chars < min_identical_chars:
+        output_path_failed = f"{output_path}.failed"
+        os.replace(output_path, output_path_failed)
+        raise Exception(f"exported model doesn't match the eager model, moved it to {output_path_failed}")
+
+
+def do_prepare_store(model, verify, logger, tokenizer_tavbert, dnikud_model):
+    if verify:
+        model_path = MODEL_PATHS[model][0]
+        folder = model_path if os.path.isdir(model_path) else os.path.dirname(model_path)
+        if not check_model_store(folder, verify_checksums=True):
+            raise Exception(f"no model store in {folder}, prepare it with: python main.py prepare_store")
+        msg = f'model store {folder} matches its manifest'
+        logger.info(msg)
+        return
+
+    # loading the model extracts the archive parts if needed, and checks the weights load
+    nikud_model = load_nikud_model(model, 'cpu')
+    nikud_model.prepare_store()
+    msg = f'prepared model store in {nikud_model.store_folder()}'
+    logger.info(msg)
+
+
+def do_preprocess(data_folder, cache_folder, evaluate_paths, logger, tokenizer_tavbert, dnikud_model):
+    """
+    Builds the pre-tokenized caches train and evaluate read their data from with --cache_folder: the train, dev
+    and test folders as train reads them, and the evaluate_paths as evaluate reads them. Caches that are up to
+    date are kept.
+    """
+    start_time = time.time()
+    datasets = [(os.path.join(data_folder, split), True) for split in ["train", "dev", "test"]] + \
+               [(path, False) for path in evaluate_paths]
+    for path, is_train in datasets:
+        location = {"folder": path} if os.path.isdir(path) else {"file": path}
+        dataset = NikudDataset(tokenizer_tavbert, logger=logger, max_length=MAX_LENGTH_SEN, is_train=is_train,
+                               cache_folder=cache_folder, **location)
+        msg = f'{path}: {len(dataset)} sentences, {len(dataset.all_labels())} letters'
+        logger.info(msg)
+
+    msg = f'Dataset caches are ready in {cache_folder} after {time.time() - start_time:.1f}s'
+    logger.info(msg)
 
 
 def do_train(logger, plots_folder, dir_model_config, tokenizer_tavbert, dnikud_model, output_trained_model_dir,
-             data_folder, n_epochs, checkpoints_frequency, learning_rate, batch_size):
+             data_folder, n_epochs, checkpoints_frequency, learning_rate, batch_size, cache_folder=None, num_workers=0,
+             stream=False, accumulation_steps=1, bf16=False, feature_folder=None, features_fp16=False):
+    if stream and feature_folder is not None:
+        raise ValueError("--feature_folder encodes the train sentences once, it can't be used with --stream")
+
     msg = 'Loading data...'
     logger.debug(msg)
 
-    dataset_train = NikudDataset(tokenizer_tavbert,
-                                 folder=os.path.join(data_folder, "train"),
-                                 logger=logger,
-                                 max_length=MAX_LENGTH_SEN,
-                                 is_train=True)
+    if stream:
+        dataset_train = IterableNikudDataset(tokenizer_tavbert,
+                                             folder=os.path.join(data_folder, "train"),
+                                             max_length=MAX_LENGTH_SEN,
+                                             is_train=True)
+    else:
+        # the feature store is keyed by the dataset cache of the train sentences, kept with it if there is no other
+        dataset_train = NikudDataset(tokenizer_tavbert,
+                                     folder=os.path.join(data_folder, "train"),
+                                     logger=logger,
+                                     max_length=MAX_LENGTH_SEN,
+                                     is_train=True,
+                                     cache_folder=cache_folder if feature_folder is None else
+                                     cache_folder or feature_folder)
     dataset_dev = NikudDataset(tokenizer=tokenizer_tavbert,
                                folder=os.path.join(data_folder, "dev"),
                                logger=logger,
                                max_length=dataset_train.max_length,
-                               is_train=True)
+                               is_train=True,
+                               cache_folder=cache_folder)
     dataset_test = NikudDataset(tokenizer=tokenizer_tavbert,
                                 folder=os.path.join(data_folder, "test"),
                                 logger=logger,
                                 max_length=dataset_train.max_length,
-                                is_train=True)
+                                is_train=True,
+                                cache_folder=cache_folder)
 
-    dataset_train.show_data_labels(plots_folder=plots_folder)
+    if not stream:
+        dataset_train.show_data_labels(plots_folder=plots_folder)
 
     msg = f'Max length of data: {dataset_train.max_length}'
     logger.debug(msg)
 
-    msg = f'Num rows in train data: {len(dataset_train.data)}, ' \
-          f'Num rows in dev data: {len(dataset_dev.data)}, ' \
-          f'Num rows in test data: {len(dataset_test.data)}'
+    msg = f'Num rows in train data: {"streamed" if stream else len(dataset_train)}, ' \
+          f'Num rows in dev data: {len(dataset_dev)}, ' \
+          f'Num rows in test data: {len(dataset_test)}'
     logger.debug(msg)
 
-    msg = 'Loading tokenizer and prepare data...'
-    logger.debug(msg)
+    pin_memory = DEVICE == 'cuda'
+    if stream or num_workers > 0:
+        # the sentences are tokenized in the loader workers while the model trains, each batch padded to its longest
+        msg = f'Tokenizing on the fly with {num_workers} loader workers'
+        logger.debug(msg)
+
+        if feature_folder is None:
+            mtb_train_dl = create_training_data_loader(dataset_train, batch_size, num_workers, pin_memory)
+        mtb_dev_dl = create_training_data_loader(dataset_dev, batch_size, num_workers, pin_memory)
+    else:
+        msg = 'Loading tokenizer and prepare data...'
+        logger.debug(msg)
+
+        if feature_folder is None:
+            dataset_train.prepare_data(name="train")
+        dataset_dev.prepare_data(name="dev")
+        dataset_test.prepare_data(name="test")
+
+        if feature_folder is None:
+            mtb_train_dl = torch.utils.data.DataLoader(dataset_train.prepered_data, batch_size=batch_size)
+        mtb_dev_dl = torch.utils.data.DataLoader(dataset_dev.prepered_data, batch_size=batch_size)
 
-    dataset_train.prepare_data(name="train")
-    dataset_dev.prepare_data(name="dev")
-    dataset_test.prepare_data(name="test")
+    if feature_folder is not None:
+        # the frozen encoder runs once over the train sentences, the epochs only train the layers after it
+        msg = f'Loading the train features from {feature_folder}'
+        logger.debug(msg)
 
-    mtb_train_dl = torch.utils.data.DataLoader(dataset_train.prepered_data, batch_size=batch_size)
-    mtb_dev_dl = torch.utils.data.DataLoader(dataset_dev.prepered_data, batch_size=batch_size)
+        feature_store = open_feature_store(dnikud_model, dataset_train.cache, feature_folder, features_fp16,
+                                           batch_size, DEVICE, logger)
+        mtb_train_dl = create_feature_data_loader(feature_store, batch_size, num_workers, pin_memory)
 
     if not os.path.isfile(dir_model_config):
         our_model_config = ModelConfig(dataset_train.max_length)
@@ -281,7 +633,9 @@ def do_train(logger, plots_folder, dir_model_config, tokenizer_tavbert, dnikud_m
     criterion_dagesh = nn.CrossEntropyLoss(ignore_index=Nikud.PAD_OR_IRRELEVANT).to(DEVICE)
     criterion_sin = nn.CrossEntropyLoss(ignore_index=Nikud.PAD_OR_IRRELEVANT).to(DEVICE)
 
-    training_params = {"n_epochs": n_epochs, "checkpoints_frequency": checkpoints_frequency}
+    training_params = {"n_epochs": n_epochs, "checkpoints_frequency": checkpoints_frequency,
+                       "accumulation_steps": accumulation_steps, "bf16": bf16,
+                       "features": feature_folder is not None}
     (best_model_details, best_accuracy, epochs_loss_train_values, steps_loss_train_values, loss_dev_values,
      accuracy_dev_values) = training(
         dnikud_model,
@@ -308,7 +662,8 @@ def do_train(logger, plots_folder, dir_model_config, tokenizer_tavbert, dnikud_m
 
 
 if __name__ == '__main__':
-    tokenizer_tavbert = AutoTokenizer.from_pretrained("tau/tavbert-he")
+    # the local bundle saved by prepare_store, so only a missing bundle needs the hub
+    tokenizer_tavbert = load_tavbert_tokenizer(TOKENIZER_FOLDER)
 
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
                                      description="""Predict D-nikud""")
@@ -325,8 +680,37 @@ if __name__ == '__main__':
                                 help='pre-train model path - use only if you want to use trained model weights')
     parser_predict.add_argument('-c', '--compare', dest='compare_nakdimon',
                                 default=False, help='predict text for comparing with Nakdimon')
+    parser_predict.add_argument('-p', '--padding', choices=['max_length', 'longest'], default='max_length',
+                                help='pad every sentence to the max length, or each batch to its longest sentence')
+    parser_predict.add_argument('-b', '--bucketing', action='store_true',
+                                help='with --padding longest, batch sentences of similar length together')
+    parser_predict.add_argument('-s', '--stream', action='store_true',
+                                help='read, predict and write each file block by block, with bounded memory')
+    parser_predict.add_argument('--max_block_chars', type=int, default=MAX_BLOCK_CHARS,
+                                help='with --stream, about how many chars of sentences are predicted at once')
     parser_predict.set_defaults(func=do_predict)
 
+    parser_parallel = subparsers.add_parser('predict_parallel',
+                                            help='diacritize a folder of text files with several worker processes')
+    parser_parallel.add_argument('input_path', help='input folder')
+    parser_parallel.add_argument('output_path', help='output folder, also holds the manifest of completed files')
+    parser_parallel.add_argument('-ptmp', '--pretrain_model_path', type=str,
+                                 default=os.path.join(Path(__file__).parent, 'models', 'Dnikud_best_model.pth'),
+                                 help='pre-train model path - use only if you want to use trained model weights')
+    parser_parallel.add_argument('-w', '--workers', type=int, default=4,
+                                 help='number of worker processes, each holding its own model')
+    parser_parallel.add_argument('--threads_per_worker', type=int, default=None,
+                                 help='number of torch threads of each worker (default: number of cores / workers)')
+    parser_parallel.add_argument('-c', '--compare', dest='compare_nakdimon',
+                                 default=False, help='predict text for comparing with Nakdimon')
+    parser_parallel.add_argument('-p', '--padding', choices=['max_length', 'longest'], default='max_length',
+                                 help='pad every sentence to the max length, or each batch to its longest sentence')
+    parser_parallel.add_argument('-b', '--bucketing', action='store_true',
+                                 help='with --padding longest, batch sentences of similar length together')
+    parser_parallel.add_argument('--max_block_chars', type=int, default=MAX_BLOCK_CHARS,
+                                 help='the most chars of a file a worker holds in memory at once')
+    parser_parallel.set_defaults(func=do_predict_parallel)
+
     parser_evaluate = subparsers.add_parser('evaluate', help='evaluate D-nikud')
     parser_evaluate.add_argument('input_path', help='input file or folder')
     parser_evaluate.add_argument('-ptmp', '--pretrain_model_path', type=str,
@@ -338,8 +722,38 @@ if __name__ == '__main__':
                                  default=False, help='accuracy calculation includes the evaluation of sub-folders '
                                                      'within the input_path folder, providing independent assessments '
                                                      'for each subfolder.')
+    parser_evaluate.add_argument('--cache_folder', default=None,
+                                 help='read the data from its pre-tokenized cache in this folder, which is built '
+                                      'first if it is missing or out of date (see preprocess)')
     parser_evaluate.set_defaults(func=do_evaluate)
 
+    parser_quantization = subparsers.add_parser('quantization_report',
+                                                help='compare accuracy and speed of D-nikud with int8 quantization')
+    parser_quantization.add_argument('input_path', help='input file or folder')
+    parser_quantization.add_argument('-ptmp', '--pretrain_model_path', type=str,
+                                     default=os.path.join(Path(__file__).parent, 'models', 'Dnikud_best_model.pth'),
+                                     help='pre-train model path - use only if you want to use trained model weights')
+    parser_quantization.add_argument('-df', '--plots_folder', dest='plots_folder',
+                                     default=os.path.join(Path(__file__).parent, 'plots'), help='set the debug folder')
+    parser_quantization.set_defaults(func=do_quantization_report)
+
+    parser_export = subparsers.add_parser('export', help='export a server model to a graph runtime format')
+    parser_export.add_argument('--model', choices=['dnikud', 'dicta'], default='dicta', help='model to export')
+    parser_export.add_argument('-f', '--format', dest='export_format', choices=['onnx', 'torchscript'],
+                               default='onnx', help='export format')
+    parser_export.add_argument('--corpus', dest='corpus_path', default=None,
+                               help='text file of the parity check, one text per line (default: built in samples)')
+    parser_export.add_argument('--min_identical_chars', type=float, default=0.999,
+                               help='minimal fraction of output chars identical to the eager model')
+    parser_export.set_defaults(func=do_export)
+
+    parser_store = subparsers.add_parser('prepare_store',
+                                         help='write the server model weights as a memory mappable model store')
+    parser_store.add_argument('--model', choices=['dnikud', 'dicta'], default='dicta', help='model to prepare')
+    parser_store.add_argument('--verify', action='store_true',
+                              help='only check the checksums of an existing model store')
+    parser_store.set_defaults(func=do_prepare_store)
+
     # train --n_epochs 20
 
     parser_train = subparsers.add_parser('train', help='train D-nikud')
@@ -349,14 +763,44 @@ if __name__ == '__main__':
     parser_train.add_argument('--learning_rate', type=float, default=0.001, help='Learning rate')
     parser_train.add_argument('--batch_size', type=int, default=32, help='batch_size')
     parser_train.add_argument('--n_epochs', type=int, default=10, help='number of epochs')
+    parser_train.add_argument('--accumulation_steps', type=int, default=1,
+                              help='number of batches whose gradients are summed per optimizer step, so the '
+                                   'effective batch size is batch_size * accumulation_steps')
+    parser_train.add_argument('--bf16', action='store_true',
+                              help='run the forward pass in bfloat16 autocast, the losses and weights stay float32')
     parser_train.add_argument('--data_folder', dest='data_folder',
                               default=os.path.join(Path(__file__).parent, 'data'), help='Set the debug folder')
     parser_train.add_argument('--checkpoints_frequency', type=int, default=1,
                               help='checkpoints frequency for save the model')
     parser_train.add_argument('-df', '--plots_folder', dest='plots_folder',
                               default=os.path.join(Path(__file__).parent, 'plots'), help='Set the debug folder')
+    parser_train.add_argument('--cache_folder', default=None,
+                              help='read the data from its pre-tokenized cache in this folder, which is built '
+                                   'first if it is missing or out of date (see preprocess)')
+    parser_train.add_argument('--num_workers', type=int, default=0,
+                              help='tokenize the sentences on the fly in this many DataLoader worker processes and '
+                                   'pad each batch to its longest sentence, instead of tokenizing all of them first')
+    parser_train.add_argument('-s', '--stream', action='store_true',
+                              help='stream the train sentences from the text files instead of loading them, with '
+                                   'memory independent of the corpus size (implies tokenizing on the fly)')
+    parser_train.add_argument('--feature_folder', default=None,
+                              help='run the frozen encoder once over the train sentences and keep its features in '
+                                   'a memory mapped store in this folder, so the epochs only run the trained layers')
+    parser_train.add_argument('--features_fp16', action='store_true',
+                              help='keep the features of --feature_folder in float16, half the disk and memory')
     parser_train.set_defaults(func=do_train)
 
+    parser_preprocess = subparsers.add_parser('preprocess',
+                                              help='build the pre-tokenized dataset caches of train and evaluate')
+    parser_preprocess.add_argument('--data_folder', dest='data_folder',
+                                   default=os.path.join(Path(__file__).parent, 'data'),
+                                   help='data folder with train, dev and test sub folders')
+    parser_preprocess.add_argument('--cache_folder', default=os.path.join(Path(__file__).parent, 'data_cache'),
+                                   help='folder of the dataset caches')
+    parser_preprocess.add_argument('-e', '--evaluate_paths', nargs='*', default=[],
+                                   help='files or folders to also cache for evaluate')
+    parser_preprocess.set_defaults(func=do_preprocess)
+
     args = parser.parse_args()
     kwargs = vars(args).copy()
     date_time = datetime.now().strftime('%d_%m_%y__%H_%M')
@@ -370,15 +814,11 @@ if __name__ == '__main__':
     msg = 'Loading model...'
     logger.debug(msg)
 
-    if args.command in ["evaluate", "predict"] or (args.command == "train" and args.pretrain_model_path is not None):
-        dir_model_config = os.path.join("models", "config.yml")
-        config = ModelConfig.load_from_file(dir_model_config)
-
-        dnikud_model = DNikudModel(config, len(Nikud.label_2_id["nikud"]), len(Nikud.label_2_id["dagesh"]),
-                                   len(Nikud.label_2_id["sin"]), device=DEVICE).to(DEVICE)
-        state_dict_model = dnikud_model.state_dict()
-        state_dict_model.update(torch.load(args.pretrain_model_path, map_location=DEVICE))
-        dnikud_model.load_state_dict(state_dict_model)
+    if args.command in ["export", "prepare_store", "predict_parallel", "preprocess"]:
+        # these load their models by themselves, or need none
+        dnikud_model = None
+    elif args.command in ["evaluate", "predict", "quantization_report"] or (args.command == "train" and args.pretrain_model_path is not None):
+        dnikud_model = load_trained_model(args.pretrain_model_path)
     else:
         base_model_name = "tau/tavbert-he"
         config = AutoConfig.from_pretrained(base_model_name)
@@ -396,7 +836,8 @@ if __name__ == '__main__':
         dir_model_config = os.path.join(kwargs['output_model_dir'], "config.yml")
         kwargs['dir_model_config'] = dir_model_config
         kwargs['output_trained_model_dir'] = output_trained_model_dir
-    del kwargs['pretrain_model_path']
+    if args.command != "predict_parallel":
+        kwargs.pop('pretrain_model_path', None)
     del kwargs['output_model_dir']
     kwargs['dnikud_model'] = dnikud_model
 
@@ -0,0 +1,102 @@
+import os
+import re
+import threading
+import time
+
+
+def load_manual_fixes(fixes_file):
+    # fixes file format: a header line, then one "before|a|after" fix per line
+    fixes = {}
+    if os.path.exists(fixes_file):
+        with open(fixes_file, "r", encoding="utf-8") as f:
+            next(f, None)  # Skip the first line
+            for line in f:
+                parts = line.strip().split("|a|")
+                if len(parts) == 2 and parts[0] != "":
+                    fixes[parts[0]] = parts[1]
+    return fixes
+
+
+def trie_pattern(words):
+    """
+    Builds a regex matching any of the words, nested by common prefixes so it is matched in a single pass
+    over the text however many words there are. At each position the longest matching word wins.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}  # a word ends here
+
+    def node_pattern(node):
+        branches = [re.escape(char) + node_pattern(child) for char, child in sorted(node.items()) if char != ""]
+        if not branches:
+            return ""
+        if len(branches) == 1 and "" not in node:
+            return branches[0]
+        # greedy optional group - a word ending here is only used if no longer word matches
+        return "(?:" + "|".join(branches) + ")" + ("?" if "" in node else "")
+
+    return re.compile(node_pattern(trie))
+
+
+class ManualFixes:
+    """
+    Applies the manual fixes file to the model output with a precompiled pattern and a direct lookup map.
+
+    The file is checked for changes at most once every `check_interval` seconds and reloaded when it changed,
+    requests arriving meanwhile keep using the previous fixes rather than waiting for the reload.
+    """
+
+    def __init__(self, fixes_file, check_interval=1.0):
+        self.fixes_file = fixes_file
+        self.check_interval = check_interval
+
+        self._engine = (None, {})  # (pattern, replacements), swapped as a whole on reload
+        self._file_state = None
+        self._last_check = 0.0
+        self._reload_lock = threading.Lock()
+
+        self.reload()
+
+    def __len__(self):
+        return len(self._engine[1])
+
+    def apply(self, text):
+        self._reload_if_changed()
+
+        pattern, replacements = self._engine
+        if pattern is None:
+            return text
+        return pattern.sub(lambda m: replacements[m.group(0)], text)
+
+    def reload(self):
+        file_state = self._get_file_state()
+        replacements = load_manual_fixes(self.fixes_file)
+        pattern = trie_pattern(replacements) if replacements else None
+
+        self._engine = (pattern, replacements)
+        self._file_state = file_state
+        print(f"Loaded {len(replacements)} manual fixes from {self.fixes_file}")
+
+    def _get_file_state(self):
+        try:
+            stat = os.stat(self.fixes_file)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _reload_if_changed(self):
+        now = time.monotonic()
+        if now - self._last_check < self.check_interval:
+            return
+        # only one request checks and reloads, the others go on with the current fixes
+        if not self._reload_lock.acquire(blocking=False):
+            return
+        try:
+            self._last_check = now
+            if self._get_file_state() != self._file_state:
+                self.reload()
+        finally:
+            self._reload_lock.release()
@@ -0,0 +1,121 @@
+import inspect
+import os
+
+import torch
+from torch import nn
+
+from src.inference import DNikudInferencePipeline
+
+# file extension of the exported graph, by export format
+EXPORT_EXTENSIONS = {"torchscript": ".torchscript.pt", "onnx": ".onnx"}
+INPUT_NAMES = ["input_ids", "attention_mask"]
+
+
+class DNikudGraph(nn.Module):
+    """
+    DNikudModel with the argmax folded into the graph: input ids and attention mask -> nikud, dagesh and sin ids
+    of every token, shape (batch, length, 3).
+    """
+
+    output_names = ["predictions"]
+
+    def __init__(self, dnikud_model):
+        super().__init__()
+        self.dnikud_model = dnikud_model
+
+    def forward(self, input_ids, attention_mask):
+        nikud_probs, dagesh_probs, sin_probs = self.dnikud_model(input_ids, attention_mask)
+        return torch.stack([nikud_probs.argmax(dim=-1), dagesh_probs.argmax(dim=-1), sin_probs.argmax(dim=-1)],
+                           dim=-1)
+
+
+class DictaBERTGraph(nn.Module):
+    """
+    BertForDiacritization with the argmax folded into the graph: input ids and attention mask -> nikud ids and
+    shin ids of every token.
+    """
+
+    output_names = ["nikud_predictions", "shin_predictions"]
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        logits = self.model(input_ids, attention_mask=attention_mask, return_dict=True).logits
+        return logits.nikud_logits.argmax(dim=-1), logits.shin_logits.argmax(dim=-1)
+
+
+def export_graph(graph: nn.Module, example_inputs: tuple, output_path: str, export_format: str):
+    """
+    Exports the graph with dynamic batch and sequence dimensions. TorchScript graphs are traced and frozen,
+    so the weights are folded into the graph as constants.
+    """
+    graph.eval()
+    if export_format == "torchscript":
+        with torch.no_grad():
+            traced = torch.jit.freeze(torch.jit.trace(graph, example_inputs, check_trace=False))
+        torch.jit.save(traced, output_path)
+    elif export_format == "onnx":
+        dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in INPUT_NAMES + graph.output_names}
+        options = {}
+        if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+            # newer torch versions default to the dynamo exporter, which needs onnxscript
+            options["dynamo"] = False
+        with torch.no_grad():
+            torch.onnx.export(graph, example_inputs, output_path, input_names=INPUT_NAMES,
+                              output_names=graph.output_names, dynamic_axes=dynamic_axes, opset_version=17,
+                              **options)
+    else:
+        raise ValueError(f"Invalid export format: {export_format}")
+
+
+class ExportedGraph:
+    """
+    Runs an exported graph on int64 numpy inputs and returns its outputs as a list of numpy arrays.
+
+    ONNX graphs run on onnxruntime, which is only imported when used. Its session is created lazily in the
+    process that runs it, since the session's thread pools don't survive a fork.
+    """
+
+    def __init__(self, path: str):
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"No exported graph at {path}, create it with: python main.py export")
+
+        self.path = path
+        self.export_format = "onnx" if path.endswith(EXPORT_EXTENSIONS["onnx"]) else "torchscript"
+
+        self._module = None
+        self._session = None
+        self._session_pid = None
+        if self.export_format == "torchscript":
+            self._module = torch.jit.load(path, map_location="cpu")
+
+    def __call__(self, *inputs):
+        if self.export_format == "torchscript":
+            with torch.inference_mode():
+                outputs = self._module(*[torch.from_numpy(array) for array in inputs])
+            if isinstance(outputs, torch.Tensor):
+                outputs = (outputs,)
+            return [output.numpy() for output in outputs]
+
+        return self._ensure_session().run(None, dict(zip(INPUT_NAMES, inputs)))
+
+    def _ensure_session(self):
+        if self._session_pid != os.getpid():
+            import onnxruntime
+
+            options = onnxruntime.SessionOptions()
+            options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+            # follows the thread budget the process set for torch, e.g. by prefork_server
+            options.intra_op_num_threads = torch.get_num_threads()
+            self._session = onnxruntime.InferenceSession(self.path, options, providers=["CPUExecutionProvider"])
+            self._session_pid = os.getpid()
+        return self._session
+
+
+class ExportedDNikudPipeline(DNikudInferencePipeline):
+    # self.model is a DNikudGraph ExportedGraph, which already returns the predicted ids
+
+    def run(self, input_ids, attention_mask):
+        return self.model(input_ids.numpy(), attention_mask.numpy())[0]
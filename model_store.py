@@ -0,0 +1,55 @@
+import hashlib
+import json
+import os
+
+from safetensors.torch import load_file, save_file
+
+# lists the files of a prepared model store with their sizes and sha256 checksums
+MANIFEST_FILE = "manifest.json"
+
+
+def file_sha256(path: str, chunk_size: int = 16 * 1024 * 1024) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def write_manifest(folder: str, files: list[str]):
+    manifest = {"files": {os.path.relpath(file, folder): {"size": os.path.getsize(file), "sha256": file_sha256(file)}
+                          for file in files}}
+    with open(os.path.join(folder, MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+
+
+def check_model_store(folder: str, verify_checksums: bool = False) -> bool:
+    """
+    Returns whether the folder holds a prepared model store.
+    By default only the file sizes are checked, so the weights are not read and stay lazily paged in.
+    With verify_checksums every file is hashed against the manifest. A store that doesn't match raises.
+    """
+    manifest_path = os.path.join(folder, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return False
+
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+
+    for name, details in manifest["files"].items():
+        path = os.path.join(folder, name)
+        if not os.path.exists(path) or os.path.getsize(path) != details["size"]:
+            raise ValueError(f"Model store {folder} is incomplete: {name} is missing or truncated")
+        if verify_checksums and file_sha256(path) != details["sha256"]:
+            raise ValueError(f"Model store {folder} is corrupted: checksum of {name} doesn't match")
+    return True
+
+
+def save_state_dict(state_dict: dict, path: str):
+    # metadata format "pt" lets transformers from_pretrained read the file too
+    save_file({name: tensor.contiguous() for name, tensor in state_dict.items()}, path, metadata={"format": "pt"})
+
+
+def load_state_dict(path: str) -> dict:
+    # the tensors are memory mapped, their pages are read on first use and shared between processes
+    return load_file(path, device="cpu")
@@ -1,5 +1,6 @@
 from dataclasses import dataclass
 from typing import List, Optional, Tuple, Union
+import numpy as np
 import torch
 from torch import nn
 from transformers.utils import ModelOutput
@@ -127,7 +128,7 @@ class BertForDiacritization(BertPreTrainedModel):
             attentions=bert_outputs.attentions,
         )
     
-    def predict(self, sentences: List[str], tokenizer: BertTokenizerFast, mark_matres_lectionis: str = None, padding='longest'):
+    def predict(self, sentences: List[str], tokenizer: BertTokenizerFast, mark_matres_lectionis: str = None, padding='longest', inference_mode: bool = True):
         sentences = [remove_nikkud(sentence) for sentence in sentences]
         # assert the lengths aren't out of range
         assert all(len(sentence) + 2 <= tokenizer.model_max_length for sentence in sentences), f'All sentences must be <= {tokenizer.model_max_length}, please segment and try again'
@@ -137,43 +138,52 @@ class BertForDiacritization(BertPreTrainedModel):
         offset_mapping = inputs.pop('offset_mapping')
         inputs = {k:v.to(self.device) for k,v in inputs.items()}
         
-        # calculate the predictions
-        logits = self.forward(**inputs, return_dict=True).logits
-        nikud_predictions = logits.nikud_logits.argmax(dim=-1).tolist()
-        shin_predictions = logits.shin_logits.argmax(dim=-1).tolist()
-
-        ret = []
-        for sent_idx,(sentence,sent_offsets) in enumerate(zip(sentences, offset_mapping)):
-            # assign the nikud to each letter!
-            output = []
-            prev_index = 0
-            for idx,offsets in enumerate(sent_offsets):
-                # add in anything we missed
-                if offsets[0] > prev_index:
-                    output.append(sentence[prev_index:offsets[0]])
-                if offsets[1] - offsets[0] != 1: continue
-                
-                # get our next char
-                char = sentence[offsets[0]:offsets[1]]
-                prev_index = offsets[1]
-                if not is_hebrew_letter(char):
-                    output.append(char)
-                    continue
-                
-                nikud = self.config.nikud_classes[nikud_predictions[sent_idx][idx]]
-                shin = '' if char != 'ש' else self.config.shin_classes[shin_predictions[sent_idx][idx]] 
-
-                # check for matres lectionis
-                if nikud == self.config.mat_lect_token:
-                    if not is_matres_letter(char): nikud = '' # don't allow matres on irrelevant letters
-                    elif mark_matres_lectionis is not None: nikud = mark_matres_lectionis
-                    else: continue
-
-                output.append(char + shin + nikud)
-            output.append(sentence[prev_index:])
-            ret.append(''.join(output))
-        
-        return ret
+        # calculate the predictions, without recording an autograd graph unless asked to
+        with torch.inference_mode(inference_mode):
+            logits = self.forward(**inputs, return_dict=True).logits
+            nikud_predictions = logits.nikud_logits.argmax(dim=-1).cpu().numpy()
+            shin_predictions = logits.shin_logits.argmax(dim=-1).cpu().numpy()
+
+        return self.decode(sentences, offset_mapping.numpy(), nikud_predictions, shin_predictions, mark_matres_lectionis)
+
+    def decode(self, sentences: List[str], offset_mapping: np.ndarray, nikud_predictions: np.ndarray, shin_predictions: np.ndarray, mark_matres_lectionis: str = None):
+        return decode_predictions(self.config, sentences, offset_mapping, nikud_predictions, shin_predictions, mark_matres_lectionis)
+
+def decode_predictions(config, sentences: List[str], offset_mapping: np.ndarray, nikud_predictions: np.ndarray, shin_predictions: np.ndarray, mark_matres_lectionis: str = None):
+    nikud_table = np.array(config.nikud_classes + [''], dtype=object)
+    shin_table = np.array(config.shin_classes + [''], dtype=object)
+    mat_lect_id = config.nikud_classes.index(config.mat_lect_token)
+
+    ret = []
+    for sentence, sent_offsets, sent_nikud, sent_shin in zip(sentences, offset_mapping, nikud_predictions, shin_predictions):
+        # one output piece per char of the sentence, chars the model didn't see stay as they are
+        pieces = np.array(list(sentence), dtype=object)
+        codes = np.frombuffer(sentence.encode('utf-32-le', 'surrogatepass'), dtype=np.uint32)
+
+        # only single char tokens get nikud, and only on hebrew letters
+        single_char = sent_offsets[:, 1] - sent_offsets[:, 0] == 1
+        positions = sent_offsets[single_char, 0]
+        hebrew = (codes[positions] >= ALEF_ORD) & (codes[positions] <= TAF_ORD)
+        positions = positions[hebrew]
+        letter_codes = codes[positions]
+        nikud_ids = sent_nikud[single_char][hebrew]
+        shin_ids = np.where(letter_codes == SHIN_ORD, sent_shin[single_char][hebrew], len(config.shin_classes))
+
+        # check for matres lectionis
+        mat_lect = nikud_ids == mat_lect_id
+        matres = mat_lect & np.isin(letter_codes, MATRES_ORDS)
+        nikud_ids[mat_lect & ~matres] = 0 # don't allow matres on irrelevant letters
+        nikud = nikud_table[nikud_ids]
+        if mark_matres_lectionis is not None:
+            nikud[matres] = mark_matres_lectionis
+
+        pieces[positions] = pieces[positions] + shin_table[shin_ids] + nikud
+        if mark_matres_lectionis is None:
+            pieces[positions[matres]] = ''
+
+        ret.append(''.join(pieces.tolist()))
+
+    return ret
 
 ALEF_ORD = ord('א')
 TAF_ORD = ord('ת')
@@ -181,6 +191,8 @@ def is_hebrew_letter(char):
    return ALEF_ORD <= ord(char) <= TAF_ORD
 
 MATRES_LETTERS = list('אוי')
+MATRES_ORDS = [ord(char) for char in MATRES_LETTERS]
+SHIN_ORD = ord('ש')
 def is_matres_letter(char):
     return char in MATRES_LETTERS
 
@@ -0,0 +1,112 @@
+import sys
+import threading
+from collections import OrderedDict
+
+from text_segmentation import split_sentences
+
+
+class PredictionCache:
+    """
+    Thread safe LRU cache of model outputs, bounded both by number of entries and by their approximate size.
+    """
+
+    def __init__(self, max_entries=10000, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = self._entry_size(key, value)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self.size_bytes -= self._entry_size(key, self._entries.pop(key))
+            self._entries[key] = value
+            self.size_bytes += size
+
+            while len(self._entries) > self.max_entries or self.size_bytes > self.max_bytes:
+                old_key, old_value = self._entries.popitem(last=False)
+                self.size_bytes -= self._entry_size(old_key, old_value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self._entries),
+                    "size_bytes": self.size_bytes,
+                    "max_entries": self.max_entries,
+                    "max_bytes": self.max_bytes,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0}
+
+    @staticmethod
+    def _entry_size(key, value):
+        # keys are (model identity, text) tuples
+        return sys.getsizeof(key[1]) + sys.getsizeof(value)
+
+
+class CachedNikudModel:
+    """
+    Wraps a NikudModel with a PredictionCache.
+
+    The cache holds the raw model output, before the manual fixes, keyed on the model identity and the
+    text the model actually sees (NikudModel.normalize), so editing the fixes file doesn't invalidate it.
+    By default whole texts are cached, so the output is the same as without the cache. With per_sentence the
+    texts are cached sentence by sentence, so paragraphs that only partially repeat still hit the cache - at
+    the cost of the model seeing each sentence without its neighbours.
+    """
+
+    def __init__(self, nikud_model, cache: PredictionCache, per_sentence=False):
+        self.nikud_model = nikud_model
+        self.cache = cache
+        self.per_sentence = per_sentence
+
+    def predict(self, sentence: str) -> str:
+        return self.predict_multiple([sentence])[0]
+
+    def predict_multiple(self, sentences: list[str]) -> list[str]:
+        identity = self.nikud_model.identity()
+        keys = [[(identity, self.nikud_model.normalize(segment)) for segment in
+                 (split_sentences(text) if self.per_sentence else [text])] for text in sentences]
+
+        outputs = {}
+        misses = {}
+        for text_keys in keys:
+            for key in text_keys:
+                if key in outputs or key in misses:
+                    continue
+                output = self.cache.get(key)
+                if output is None:
+                    misses[key] = key[1]
+                else:
+                    outputs[key] = output
+
+        if misses:
+            predictions = self.nikud_model.predict_multiple(list(misses.values()))
+            for key, output in zip(misses.keys(), predictions):
+                self.cache.put(key, output)
+                outputs[key] = output
+
+        return ["".join(outputs[key] for key in text_keys) for text_keys in keys]
@@ -0,0 +1,118 @@
+import gc
+import os
+import signal
+import socket
+import time
+
+import torch
+from werkzeug.serving import make_server
+
+import Nikud_server
+from Nikud_server import create_arg_parser, load_server_model
+
+# a worker that dies is restarted after this delay, so a crashing worker doesn't spin the parent
+RESTART_DELAY = 1.0
+
+
+def parse_args():
+    parser = create_arg_parser(description="Run Nikud model server with several worker processes")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Number of worker processes sharing the model weights (default: 4)"
+    )
+    parser.add_argument(
+        "--threads_per_worker",
+        type=int,
+        default=None,
+        help="Number of torch intra-op threads of each worker (default: number of cores / workers)"
+    )
+    return parser.parse_args()
+
+
+def run_worker(args, listen_socket, nikud_model, cache, batcher, num_threads):
+    # the parent forwards SIGTERM on Ctrl-C, so the workers don't each raise KeyboardInterrupt
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    torch.set_num_threads(num_threads)
+
+    Nikud_server.nikud_model = nikud_model
+    Nikud_server.cache = cache
+    Nikud_server.batcher = batcher
+
+    server = make_server(args.host, args.port, Nikud_server.app, threaded=True, fd=listen_socket.fileno())
+    print(f"Worker {os.getpid()} serving with {num_threads} threads", flush=True)
+    server.serve_forever()
+
+
+def spawn_worker(*worker_args):
+    pid = os.fork()
+    if pid == 0:
+        exit_code = 0
+        try:
+            run_worker(*worker_args)
+        except BaseException as e:
+            print(f"Worker {os.getpid()} failed: {e!r}", flush=True)
+            exit_code = 1
+        finally:
+            # never return into the parent's supervision loop
+            os._exit(exit_code)
+    return pid
+
+
+def serve(args):
+    num_threads = args.threads_per_worker or max(1, (os.cpu_count() or 1) // args.workers)
+
+    # load the weights once, the forked workers share their pages copy on write. The model is frozen for
+    # inference, so nothing writes to them, and the batcher starts its thread lazily inside each worker.
+    # A CUDA context doesn't survive a fork, so the model always runs on CPU here
+    nikud_model, cache, batcher = load_server_model(args, device="cpu")
+
+    listen_socket = socket.create_server((args.host, args.port), backlog=128)
+    listen_socket.set_inheritable(True)
+
+    # move everything loaded so far out of the collector's reach, otherwise every collection in a worker
+    # touches the object headers and copies the pages they live on
+    gc.collect()
+    gc.freeze()
+
+    worker_args = (args, listen_socket, nikud_model, cache, batcher, num_threads)
+    workers = {}
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    for index in range(args.workers):
+        workers[spawn_worker(*worker_args)] = index
+    print(f"Serving on {args.host}:{args.port} with {args.workers} workers", flush=True)
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index = workers.pop(pid, None)
+        if index is None or stopping:
+            continue
+
+        print(f"Worker {pid} exited with status {os.waitstatus_to_exitcode(status)}, restarting", flush=True)
+        time.sleep(RESTART_DELAY)
+        if not stopping:
+            workers[spawn_worker(*worker_args)] = index
+
+    listen_socket.close()
+
+
+if __name__ == "__main__":
+    serve(parse_args())
@@ -0,0 +1,6 @@
+# a few sentences of different kinds, the benchmarks run on them and export checks its graphs on them by default
+SAMPLE_TEXTS = [
+    "האם בתאריך עשרים וחמישה ביוני, ביום שני, בשעה ארבע ארבעים וחמש, במרפאה ברחוב הנביאים 2, חיפה, יתאים לכם תור אצל דוקטור אביטל, מומחה לרפואת עיניים?",
+    "בשנת 1948 השלים אפרים קישון את לימודיו בפיסול מתכת ובתולדות האמנות והחל לפרסם מאמרים הומוריסטיים",
+    "שלום, הגעתם למוקד זימון התורים. לקביעת תור הקישו אחת, לביטול תור הקישו שתיים.",
+]
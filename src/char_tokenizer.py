@@ -0,0 +1,142 @@
+# general
+import json
+import os
+
+# ML
+import numpy as np
+import torch
+from transformers import AutoTokenizer
+
+from src.utiles_data import Letters
+
+TAVBERT_NAME = "tau/tavbert-he"
+CHAR_TOKENIZER_FILE = "char_tokenizer.json"
+
+
+class CharTokenizer:
+    """
+    Lookup table tokenizer for the character level TavBERT: one id per char, between the start and end tokens.
+
+    It returns the same ids as the TavBERT tokenizer on normalized text (Letters.vocab chars), and takes the
+    arguments NikudDataset and DNikudInferencePipeline call the HF tokenizer with.
+    """
+
+    def __init__(self, char_to_id: dict, bos_token_id: int, eos_token_id: int, pad_token_id: int,
+                 unk_token_id: int, model_max_length: int):
+        self.char_to_id = char_to_id
+        self.bos_token_id = bos_token_id
+        self.eos_token_id = eos_token_id
+        self.pad_token_id = pad_token_id
+        self.unk_token_id = unk_token_id
+        self.model_max_length = model_max_length
+
+        # one entry per code point up to the largest one in the vocab, the extra last entry takes all the others
+        self.table = np.full(max(map(ord, char_to_id)) + 2, unk_token_id, dtype=np.int64)
+        for char, token_id in char_to_id.items():
+            self.table[ord(char)] = token_id
+
+    @classmethod
+    def from_tokenizer(cls, tokenizer, chars=Letters.vocab):
+        bos_token_id, _, eos_token_id = tokenizer('א')['input_ids']
+        char_to_id = {}
+        for char in chars:
+            # the char sits between two letters, so tokenizers that strip whitespace at the ends still keep it
+            ids = tokenizer('א' + char + 'א', add_special_tokens=False)['input_ids']
+            if len(ids) != 3:
+                raise ValueError(f"{char!r} is not a single token, the tokenizer is not character level")
+            char_to_id[char] = ids[1]
+        return cls(char_to_id, bos_token_id, eos_token_id, tokenizer.pad_token_id, tokenizer.unk_token_id,
+                   tokenizer.model_max_length)
+
+    def save(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"char_to_id": self.char_to_id,
+                       "bos_token_id": self.bos_token_id,
+                       "eos_token_id": self.eos_token_id,
+                       "pad_token_id": self.pad_token_id,
+                       "unk_token_id": self.unk_token_id,
+                       "model_max_length": self.model_max_length}, f, ensure_ascii=False, indent=2)
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path, "r", encoding="utf-8") as f:
+            return cls(**json.load(f))
+
+    def encode_plus(self, text: str, **kwargs):
+        return self([text], **kwargs)
+
+    def __call__(self, texts, add_special_tokens=True, max_length=None, padding=False, truncation=False,
+                 return_attention_mask=True, return_tensors=None):
+        if isinstance(texts, str):
+            texts = [texts]
+        num_special = 2 if add_special_tokens else 0
+        max_chars = (max_length or self.model_max_length) - num_special if truncation else None
+
+        ids = []
+        for text in texts:
+            codes = np.frombuffer(text[:max_chars].encode('utf-32-le', 'surrogatepass'), dtype=np.uint32)
+            text_ids = self.table[np.minimum(codes, len(self.table) - 1)]
+            if add_special_tokens:
+                text_ids = np.concatenate(([self.bos_token_id], text_ids, [self.eos_token_id]))
+            ids.append(text_ids)
+
+        if padding == "max_length":
+            length = max_length or self.model_max_length
+        elif padding is True or padding == "longest":
+            length = max(len(text_ids) for text_ids in ids)
+        else:
+            length = None
+
+        if length is None:
+            encoded = {"input_ids": ids, "attention_mask": [np.ones(len(text_ids), dtype=np.int64) for text_ids in ids]}
+        else:
+            input_ids = np.full((len(ids), length), self.pad_token_id, dtype=np.int64)
+            attention_mask = np.zeros((len(ids), length), dtype=np.int64)
+            for index, text_ids in enumerate(ids):
+                input_ids[index, :len(text_ids)] = text_ids
+                attention_mask[index, :len(text_ids)] = 1
+            encoded = {"input_ids": input_ids, "attention_mask": attention_mask}
+
+        if not return_attention_mask:
+            del encoded["attention_mask"]
+        if return_tensors == "pt":
+            encoded = {name: torch.as_tensor(np.stack(value) if isinstance(value, list) else value)
+                       for name, value in encoded.items()}
+        elif return_tensors is None:
+            encoded = {name: [row.tolist() for row in value] for name, value in encoded.items()}
+        return encoded
+
+
+def load_tavbert_tokenizer(bundle_folder: str = None, char_level: bool = False):
+    """
+    Loads the TavBERT tokenizer from the local bundle saved by save_tokenizer_bundle, without touching the
+    network, or from the hub when there is no bundle. With char_level the bundle's CharTokenizer is returned.
+    """
+    if bundle_folder is not None and os.path.isdir(bundle_folder):
+        char_tokenizer_path = os.path.join(bundle_folder, CHAR_TOKENIZER_FILE)
+        if char_level and os.path.exists(char_tokenizer_path):
+            return CharTokenizer.load(char_tokenizer_path)
+        return AutoTokenizer.from_pretrained(bundle_folder, local_files_only=True)
+
+    print(f"No tokenizer bundle in {bundle_folder}, loading {TAVBERT_NAME} from the hub")
+    return AutoTokenizer.from_pretrained(TAVBERT_NAME)
+
+
+def save_tokenizer_bundle(tokenizer, bundle_folder: str) -> list[str]:
+    """
+    Saves the TavBERT tokenizer and its CharTokenizer to the bundle folder and returns the saved files.
+    The CharTokenizer is checked to encode every vocab char like the tokenizer it was built from.
+    """
+    char_tokenizer = CharTokenizer.from_tokenizer(tokenizer)
+    text = "".join(Letters.vocab)
+    for padding in ["max_length", "longest"]:
+        expected = tokenizer([text], max_length=len(text) + 8, padding=padding, truncation=True)
+        encoded = char_tokenizer([text], max_length=len(text) + 8, padding=padding, truncation=True)
+        if expected["input_ids"] != encoded["input_ids"] or expected["attention_mask"] != encoded["attention_mask"]:
+            raise ValueError("The char tokenizer doesn't encode like the tokenizer it was built from")
+
+    os.makedirs(bundle_folder, exist_ok=True)
+    files = list(tokenizer.save_pretrained(bundle_folder))
+    char_tokenizer_path = os.path.join(bundle_folder, CHAR_TOKENIZER_FILE)
+    char_tokenizer.save(char_tokenizer_path)
+    return [file for file in files if os.path.exists(file)] + [char_tokenizer_path]
@@ -0,0 +1,202 @@
+# general
+import hashlib
+import json
+import os
+import shutil
+
+# ML
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+from src.running_params import MAX_LENGTH_SEN
+from src.utiles_data import Letters, list_data_files, pad_labels
+
+# bump when what is cached for a corpus changes, e.g. the sentence splitting or the label parsing
+CACHE_FORMAT_VERSION = 1
+CACHE_META_FILE = "meta.json"
+CACHE_ARRAYS = ["input_ids", "token_offsets", "labels", "label_offsets"]
+# sentences tokenized per tokenizer call while building a cache
+TOKENIZE_CHUNK = 4096
+
+
+def log(msg, logger=None):
+    if logger:
+        logger.debug(msg)
+    else:
+        print(msg)
+
+
+def tokenizer_version(tokenizer) -> str:
+    # the ids of all the vocab chars, so the HF tokenizer and the CharTokenizer built from it share a version
+    text = "".join(Letters.vocab)
+    input_ids = tokenizer([text], add_special_tokens=True, max_length=len(text) + 2, truncation=True,
+                          padding='do_not_pad', return_attention_mask=False)["input_ids"]
+    return hashlib.sha256(json.dumps([list(input_ids[0]), tokenizer.pad_token_id]).encode()).hexdigest()[:16]
+
+
+def corpus_files(data_path: str) -> list[str]:
+    return list_data_files(data_path) if os.path.isdir(data_path) else [data_path]
+
+
+def corpus_fingerprint(data_path: str, files: list[str]) -> list:
+    # cheap to check on every load: the names, sizes and modification times of the files, in order
+    root = data_path if os.path.isdir(data_path) else os.path.dirname(data_path)
+    fingerprint = []
+    for file in files:
+        stat = os.stat(file)
+        fingerprint.append([os.path.relpath(file, root), stat.st_size, stat.st_mtime_ns])
+    return fingerprint
+
+
+def corpus_hash(data_path: str, files: list[str], chunk_size: int = 16 * 1024 * 1024) -> str:
+    root = data_path if os.path.isdir(data_path) else os.path.dirname(data_path)
+    sha256 = hashlib.sha256()
+    for file in files:
+        sha256.update(os.path.relpath(file, root).encode() + b"\0")
+        with open(file, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                sha256.update(chunk)
+        sha256.update(b"\0")
+    return sha256.hexdigest()
+
+
+def cache_path(cache_folder: str, data_path: str, is_train: bool, max_length: int) -> str:
+    # one cache per data folder or file and per way NikudDataset reads it: for training or evaluation, and the
+    # length the sentences are truncated to
+    name = os.path.basename(os.path.normpath(data_path))
+    digest = hashlib.sha256(os.path.abspath(data_path).encode()).hexdigest()[:8]
+    return os.path.join(cache_folder, f"{name}_{'train' if is_train else 'eval'}_{max_length}_{digest}")
+
+
+def read_cache_meta(path: str):
+    meta_path = os.path.join(path, CACHE_META_FILE)
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_cache_meta(path: str, meta: dict):
+    # written last and replaced atomically, so a cache with a meta file is complete
+    meta_path = os.path.join(path, CACHE_META_FILE)
+    with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2)
+    os.replace(meta_path + ".tmp", meta_path)
+
+
+def write_dataset_cache(dataset, files: list[str], path: str, meta: dict, logger=None):
+    data = []
+    for file in files:
+        data.extend(dataset.read_data(file, logger)[0])
+
+    token_ids = []
+    for start in range(0, len(data), TOKENIZE_CHUNK):
+        encoded = dataset.tokenizer([text for text, _ in data[start:start + TOKENIZE_CHUNK]],
+                                    add_special_tokens=True, max_length=dataset.max_length, truncation=True,
+                                    padding='do_not_pad', return_attention_mask=False)
+        token_ids.extend(np.asarray(ids, dtype=np.int32) for ids in encoded["input_ids"])
+
+    arrays = {
+        "input_ids": np.concatenate(token_ids + [np.empty(0, dtype=np.int32)]),
+        "token_offsets": np.concatenate(([0], np.cumsum([len(ids) for ids in token_ids], dtype=np.int64))),
+        "labels": np.concatenate([labels for _, labels in data] + [np.empty((0, 3), dtype=np.int64)]).astype(np.int8),
+        "label_offsets": np.concatenate(([0], np.cumsum([len(labels) for _, labels in data], dtype=np.int64))),
+    }
+
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for name in CACHE_ARRAYS:
+        np.save(os.path.join(tmp_path, f"{name}.npy"), arrays[name])
+    write_cache_meta(tmp_path, dict(meta, num_sentences=len(data)))
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+
+def open_dataset_cache(dataset, data_path: str, cache_folder: str, logger=None):
+    """
+    Returns the CachedNikudData of a NikudDataset folder or file, building its cache first when it is missing or
+    out of date.
+
+    A cache is keyed by the content hash of the corpus, the tokenizer version and the settings the sentences are
+    split and tokenized with. Loading it only compares the names, sizes and modification times of the files with
+    the ones it was built from, so the text is not read. The content is hashed again only when these changed.
+    """
+    if not os.path.exists(data_path):
+        raise FileNotFoundError(f"No data at {data_path}")
+
+    path = cache_path(cache_folder, data_path, dataset.is_train, dataset.max_length)
+    files = corpus_files(data_path)
+    fingerprint = corpus_fingerprint(data_path, files)
+    settings = {"format_version": CACHE_FORMAT_VERSION,
+                "tokenizer_version": tokenizer_version(dataset.tokenizer),
+                "max_length": dataset.max_length,
+                "max_length_sen": MAX_LENGTH_SEN,
+                "is_train": dataset.is_train,
+                "pad_token_id": dataset.tokenizer.pad_token_id}
+
+    meta = read_cache_meta(path)
+    if meta is not None and all(meta.get(name) == value for name, value in settings.items()):
+        if meta["fingerprint"] == fingerprint:
+            return CachedNikudData.load(path)
+        if meta["corpus_hash"] == corpus_hash(data_path, files):
+            write_cache_meta(path, dict(meta, fingerprint=fingerprint))
+            return CachedNikudData.load(path)
+
+    log(f"Building the dataset cache of {data_path} in {path}", logger)
+    meta = dict(settings, data_path=data_path, corpus_hash=corpus_hash(data_path, files), fingerprint=fingerprint)
+    write_dataset_cache(dataset, files, path, meta, logger)
+    return CachedNikudData.load(path)
+
+
+class CachedNikudData(Dataset):
+    """
+    The (input_ids, attention_mask, labels) items of NikudDataset.prepare_data, read from a dataset cache.
+
+    The token ids and labels of all the sentences are memory mapped, copy on write: sentence i is
+    input_ids[token_offsets[i]:token_offsets[i + 1]] and labels[label_offsets[i]:label_offsets[i + 1]], and
+    only the pages of the sentences read are loaded. With padding="max_length" the items are padded to max_length
+    like prepare_data pads them, with padding="longest" they are left for PaddingCollator to pad.
+    """
+
+    def __init__(self, path: str, arrays: dict, max_length: int, pad_token_id: int, padding="longest"):
+        self.path = path
+        self.arrays = arrays
+        self.input_ids = arrays["input_ids"]
+        self.token_offsets = arrays["token_offsets"]
+        self.labels = arrays["labels"]
+        self.label_offsets = arrays["label_offsets"]
+        self.max_length = max_length
+        self.pad_token_id = pad_token_id
+        self.padding = padding
+
+    @classmethod
+    def load(cls, path: str, padding="longest"):
+        meta = read_cache_meta(path)
+        arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="c") for name in CACHE_ARRAYS}
+        return cls(path, arrays, meta["max_length"], meta["pad_token_id"], padding)
+
+    def with_padding(self, padding):
+        return CachedNikudData(self.path, self.arrays, self.max_length, self.pad_token_id, padding)
+
+    def __reduce__(self):
+        # DataLoader workers map the cache again rather than receive a copy of it
+        return CachedNikudData.load, (self.path, self.padding)
+
+    def __len__(self):
+        return len(self.token_offsets) - 1
+
+    def __getitem__(self, idx):
+        input_ids = torch.from_numpy(self.input_ids[self.token_offsets[idx]:self.token_offsets[idx + 1]]).long()
+        labels = self.labels[self.label_offsets[idx]:self.label_offsets[idx + 1]]
+        num_tokens = len(input_ids)
+        if self.padding != "max_length":
+            return input_ids, torch.ones(num_tokens, dtype=torch.long), pad_labels(labels, num_tokens, num_tokens - 2)
+
+        padded_input_ids = torch.full((self.max_length,), self.pad_token_id, dtype=torch.long)
+        padded_input_ids[:num_tokens] = input_ids
+        attention_mask = torch.zeros(self.max_length, dtype=torch.long)
+        attention_mask[:num_tokens] = 1
+        return (padded_input_ids, attention_mask,
+                pad_labels(labels, self.max_length, min(len(labels), self.max_length - 1)))
@@ -0,0 +1,169 @@
+# general
+import os
+import shutil
+
+# ML
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+from src.dataset_cache import log, read_cache_meta, write_cache_meta
+from src.utiles_data import LengthBucketBatchSampler, Nikud, PaddingCollator, pad_labels
+
+# bump when what is stored for a dataset changes
+FEATURE_STORE_FORMAT_VERSION = 3
+FEATURE_STORE_ARRAYS = ["features", "pad_features", "labels", "token_offsets"]
+# the files from_pretrained reads the encoder weights from
+WEIGHT_FILE_SUFFIXES = (".bin", ".safetensors")
+# the settings of a dataset cache that fix the token ids and labels of its sentences
+DATASET_CACHE_KEYS = ["format_version", "corpus_hash", "tokenizer_version", "max_length", "max_length_sen",
+                      "is_train", "pad_token_id"]
+
+
+def encoder_version(model) -> dict:
+    # the pretrained TavBERT the frozen encoder was loaded from and its revision, and for a local folder the sizes
+    # and modification times of its weight files, so a model saved again at the same path is noticed
+    config = model.model.config
+    version = {"name": config._name_or_path, "revision": getattr(config, "_commit_hash", None)}
+    if os.path.isdir(config._name_or_path):
+        version["weight_files"] = [[name, stat.st_size, stat.st_mtime_ns] for name, stat in
+                                   ((name, os.stat(os.path.join(config._name_or_path, name)))
+                                    for name in sorted(os.listdir(config._name_or_path))
+                                    if name.endswith(WEIGHT_FILE_SUFFIXES))]
+    return version
+
+
+def feature_store_path(feature_folder: str, cache, fp16: bool) -> str:
+    # one store per dataset cache
+    return os.path.join(feature_folder, f"{os.path.basename(cache.path)}_{'fp16' if fp16 else 'fp32'}")
+
+
+def write_feature_store(model, cache, path: str, meta: dict, batch_size: int, device):
+    from tqdm import tqdm
+
+    token_offsets = cache.token_offsets.astype(np.int64)
+    lengths = np.diff(token_offsets).tolist()
+    num_tokens = int(token_offsets[-1])
+
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    features = np.lib.format.open_memmap(os.path.join(tmp_path, "features.npy"), mode="w+",
+                                         dtype=np.float16 if meta["fp16"] else np.float32,
+                                         shape=(num_tokens, model.model.config.hidden_size))
+    pad_features = np.lib.format.open_memmap(os.path.join(tmp_path, "pad_features.npy"), mode="w+",
+                                             dtype=features.dtype, shape=(len(lengths), features.shape[1]))
+    labels = np.lib.format.open_memmap(os.path.join(tmp_path, "labels.npy"), mode="w+", dtype=np.int8,
+                                       shape=(num_tokens, 3))
+
+    # sentences of similar lengths are encoded together, each one is written at its offset in the dataset order
+    batch_sampler = LengthBucketBatchSampler(lengths, batch_size)
+    loader = DataLoader(cache.with_padding("longest"), batch_sampler=batch_sampler,
+                        collate_fn=PaddingCollator(cache.pad_token_id))
+    was_training = model.training
+    model.eval()
+    with torch.inference_mode():
+        for indices, (input_ids, attention_mask, _) in zip(batch_sampler.batches,
+                                                           tqdm(loader, desc="encode features")):
+            # one more pad token, so even the longest sentence of the batch has the feature of its pads
+            input_ids = torch.nn.functional.pad(input_ids, (0, 1), value=cache.pad_token_id)
+            attention_mask = torch.nn.functional.pad(attention_mask, (0, 1), value=0)
+            hidden = model.encode(input_ids.to(device), attention_mask.to(device)).float().cpu().numpy()
+            for row, idx in enumerate(indices):
+                start, end = token_offsets[idx], token_offsets[idx + 1]
+                features[start:end] = hidden[row, :end - start]
+                pad_features[idx] = hidden[row, end - start]
+                # labeled like the max_length padded items, which label the end token of a truncated sentence
+                letter_labels = cache.labels[cache.label_offsets[idx]:cache.label_offsets[idx + 1]]
+                labels[start:end] = pad_labels(letter_labels, end - start,
+                                               min(len(letter_labels), cache.max_length - 1, end - start - 1)).numpy()
+    model.train(was_training)
+
+    features.flush()
+    pad_features.flush()
+    labels.flush()
+    del features, pad_features, labels
+    np.save(os.path.join(tmp_path, "token_offsets.npy"), token_offsets)
+    write_cache_meta(tmp_path, dict(meta, num_sentences=len(lengths), num_tokens=num_tokens))
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+
+def open_feature_store(model, cache, feature_folder: str, fp16: bool = False, batch_size: int = 32, device='cpu',
+                       logger=None):
+    """
+    Returns the FeatureNikudData of the sentences of a dataset cache (CachedNikudData), the frozen encoder's
+    last_hidden_state of their tokens, running the encoder over them first when the store is missing or out of
+    date.
+
+    Besides the features of the real tokens, the store keeps one pad feature per sentence. The pad tokens all
+    have the same position id and attend only to the real tokens, so the encoder gives every pad of a sentence
+    the same hidden state, whatever the padding length. This lets FeatureNikudData replay the padding to
+    max_length exactly.
+
+    A store is keyed by the metadata of the dataset cache, its corpus hash and tokenizer version, and by the
+    pretrained encoder's name, revision and weight files, so checking it reads neither the corpus nor the weights.
+    """
+    path = feature_store_path(feature_folder, cache, fp16)
+    cache_meta = read_cache_meta(cache.path)
+    settings = {"format_version": FEATURE_STORE_FORMAT_VERSION,
+                "dataset_cache": {name: cache_meta[name] for name in DATASET_CACHE_KEYS},
+                "encoder": encoder_version(model),
+                "fp16": fp16}
+
+    meta = read_cache_meta(path)
+    if meta is not None and all(meta.get(name) == value for name, value in settings.items()):
+        return FeatureNikudData.load(path)
+
+    log(f"Building the feature store of {cache_meta['data_path']} in {path}", logger)
+    write_feature_store(model, cache, path, dict(settings, data_path=cache_meta["data_path"]), batch_size, device)
+    return FeatureNikudData.load(path)
+
+
+class FeatureNikudData(Dataset):
+    """
+    (features, attention_mask, labels) items of the sentences of a feature store, for DNikudModel.forward_heads.
+
+    The encoder features and labels of all the tokens are memory mapped: sentence i is
+    features[token_offsets[i]:token_offsets[i + 1]]. Like the items of NikudDataset.prepare_data, the items are
+    padded to max_length, with the encoder's feature of the sentence's pads, so the Bi-LSTM heads train on what
+    they see with the default padding="max_length" of training and serving.
+    """
+
+    def __init__(self, path: str, arrays: dict, max_length: int):
+        self.path = path
+        self.features = arrays["features"]
+        self.pad_features = arrays["pad_features"]
+        self.labels = arrays["labels"]
+        self.token_offsets = arrays["token_offsets"]
+        self.max_length = max_length
+
+    @classmethod
+    def load(cls, path: str):
+        meta = read_cache_meta(path)
+        return cls(path, {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="c")
+                          for name in FEATURE_STORE_ARRAYS}, meta["dataset_cache"]["max_length"])
+
+    def __reduce__(self):
+        # DataLoader workers map the store again rather than receive a copy of it
+        return FeatureNikudData.load, (self.path,)
+
+    def __len__(self):
+        return len(self.token_offsets) - 1
+
+    def __getitem__(self, idx):
+        start, end = self.token_offsets[idx], self.token_offsets[idx + 1]
+        num_tokens = end - start
+        features = torch.empty((self.max_length, self.features.shape[1]))
+        features[:num_tokens] = torch.from_numpy(self.features[start:end])
+        features[num_tokens:] = torch.from_numpy(self.pad_features[idx])
+        attention_mask = torch.zeros(self.max_length, dtype=torch.long)
+        attention_mask[:num_tokens] = 1
+        labels = torch.full((self.max_length, 3), Nikud.PAD_OR_IRRELEVANT, dtype=torch.long)
+        labels[:num_tokens] = torch.from_numpy(self.labels[start:end])
+        return features, attention_mask, labels
+
+
+def create_feature_data_loader(feature_store, batch_size, num_workers=0, pin_memory=False):
+    return DataLoader(feature_store, batch_size=batch_size, num_workers=num_workers, pin_memory=pin_memory,
+                      persistent_workers=num_workers > 0)
@@ -0,0 +1,93 @@
+# ML
+import numpy as np
+import torch
+
+from src.running_params import BATCH_SIZE, MAX_LENGTH_SEN
+from src.utiles_data import Nikud, NORMALIZE_TABLE, labels_2_text
+
+# the diacritics in the input are labels, not text - they are dropped like in NikudDataset.read_data_list
+STRIP_NIKUD_TABLE = {nikud_ord: None for nikud_ord in Nikud.all_nikud_ord}
+
+# lookup tables over code points: can the letter hold a nikud / dagesh / sin
+_CAN_TABLE_SIZE = ord('ת') + 1
+CAN_NIKUD_DAGESH_SIN = np.zeros((_CAN_TABLE_SIZE, 3), dtype=bool)
+for _letter in ('אבגדהוזחטיכלמנסעפצקרשת' + 'ךן'):
+    CAN_NIKUD_DAGESH_SIN[ord(_letter), 0] = True
+for _letter in ('בגדהוזטיכלמנספצקשת' + 'ךף'):
+    CAN_NIKUD_DAGESH_SIN[ord(_letter), 1] = True
+CAN_NIKUD_DAGESH_SIN[ord('ש'), 2] = True
+
+
+def can_have_labels(text):
+    codes = np.fromiter(map(ord, text), dtype=np.int64, count=len(text))
+    can = np.zeros((len(text), 3), dtype=bool)
+    in_table = codes < _CAN_TABLE_SIZE
+    can[in_table] = CAN_NIKUD_DAGESH_SIN[codes[in_table]]
+    return can
+
+
+class DNikudInferencePipeline:
+    """
+    Serving path of D-Nikud: raw strings -> input ids and "can have nikud/dagesh/sin" masks -> model -> text.
+
+    It produces the same input and output as NikudDataset + models_utils.predict + back_2_text, without
+    the labels, label tensors and DataLoader the training code needs.
+    """
+
+    def __init__(self, model, tokenizer, device='cpu', batch_size=BATCH_SIZE, max_length=MAX_LENGTH_SEN,
+                 padding="max_length", bucketing=False, inference_mode=True):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.padding = padding
+        self.bucketing = bucketing
+        self.inference_mode = inference_mode
+
+    def predict(self, sentences):
+        origin_texts = [sentence.translate(STRIP_NIKUD_TABLE) for sentence in sentences]
+        indices = [i for i, text in enumerate(origin_texts) if text != ""]
+        if self.bucketing:
+            indices.sort(key=lambda i: len(origin_texts[i]))
+
+        results = [""] * len(sentences)
+        for start in range(0, len(indices), self.batch_size):
+            batch_indices = indices[start:start + self.batch_size]
+            batch_texts = [origin_texts[i] for i in batch_indices]
+            for i, output in zip(batch_indices, self.predict_batch(batch_texts)):
+                results[i] = output
+        return results
+
+    def predict_batch(self, origin_texts):
+        input_ids, attention_mask, can_masks = self.encode(origin_texts)
+        predictions = self.run(input_ids, attention_mask)
+
+        predictions[~can_masks] = Nikud.PAD_OR_IRRELEVANT
+        # position 0 is the start token, letter i sits at position i + 1
+        return [labels_2_text(text, labels[1:len(text) + 1]) for text, labels in zip(origin_texts, predictions)]
+
+    def run(self, input_ids, attention_mask):
+        # the predicted nikud, dagesh and sin ids of every token, shape (batch, length, 3)
+        with torch.inference_mode(self.inference_mode):
+            nikud_probs, dagesh_probs, sin_probs = self.model(input_ids.to(self.device),
+                                                              attention_mask.to(self.device))
+            return torch.stack([nikud_probs.argmax(dim=-1), dagesh_probs.argmax(dim=-1),
+                                sin_probs.argmax(dim=-1)], dim=-1).cpu().numpy()
+
+    def encode(self, origin_texts):
+        encoded = self.tokenizer([text.translate(NORMALIZE_TABLE) for text in origin_texts],
+                                 add_special_tokens=True,
+                                 max_length=self.max_length,
+                                 padding=self.padding,
+                                 truncation=True,
+                                 return_attention_mask=True,
+                                 return_tensors='pt')
+
+        # position 0 is the start token, letter i sits at position i + 1
+        can_masks = np.zeros((len(origin_texts), encoded['input_ids'].shape[1], 3), dtype=bool)
+        for index, text in enumerate(origin_texts):
+            text = text[:can_masks.shape[1] - 2]
+            can_masks[index, 1:len(text) + 1] = can_have_labels(text)
+
+        return encoded['input_ids'], encoded['attention_mask'], can_masks
@@ -3,6 +3,7 @@ import subprocess
 import yaml
 
 # ML
+import torch
 import torch.nn as nn
 from transformers import AutoConfig, RobertaForMaskedLM, PretrainedConfig
 
@@ -28,7 +29,14 @@ class DNikudModel(nn.Module):
         self.out_s = nn.Linear(config.hidden_size, sin_size)
 
     def forward(self, input_ids, attention_mask):
-        last_hidden_state = self.model(input_ids, attention_mask=attention_mask).last_hidden_state
+        return self.forward_heads(self.encode(input_ids, attention_mask))
+
+    def encode(self, input_ids, attention_mask):
+        # the frozen TavBERT encoder, its features of the tokens don't depend on how the batch is padded
+        return self.model(input_ids, attention_mask=attention_mask).last_hidden_state
+
+    def forward_heads(self, last_hidden_state):
+        # the trained layers, run on the encoder features, e.g. the ones of a feature store (src/feature_store.py)
         lstm1, _ = self.lstm1(last_hidden_state)
         lstm2, _ = self.lstm2(lstm1)
         dense = self.dense(lstm2)
@@ -40,6 +48,15 @@ class DNikudModel(nn.Module):
         return nikud, dagesh, sin
 
 
+# layers whose weights dynamic quantization stores as int8, the activations are quantized on the fly
+QUANTIZED_MODULES = {nn.Linear, nn.LSTM}
+
+
+def quantize_dynamic(model):
+    # swaps the layers in place, dynamically quantized kernels only run on CPU
+    return torch.ao.quantization.quantize_dynamic(model.cpu(), QUANTIZED_MODULES, dtype=torch.qint8, inplace=True)
+
+
 def get_git_commit_hash():
     try:
         commit_hash = subprocess.check_output(['git', 'rev-parse', 'HEAD']).decode('ascii').strip()
@@ -1,18 +1,13 @@
 # general
 import json
 import os
+import time
 
 # ML
 import numpy as np
-import pandas as pd
 import torch
 
-# visual
-import matplotlib.pyplot as plt
-import seaborn as sns
-from sklearn.metrics import confusion_matrix
-from tqdm import tqdm
-
+from src.plot_helpers import get_pyplot
 from src.running_params import DEBUG_MODE
 from src.utiles_data import Nikud, create_missing_folders
 
@@ -40,11 +35,12 @@ def calc_num_correct_words(input, letter_correct_mask):
     return correct_words_count, words_count
 
 
-def predict(model, data_loader, device='cpu'):
+def predict(model, data_loader, device='cpu', inference_mode=True):
     model.to(device)
 
-    all_labels = None
-    with torch.no_grad():
+    batches_labels = []
+    # inference mode also skips the view and version counter bookkeeping that no_grad still does
+    with torch.inference_mode() if inference_mode else torch.no_grad():
         for index_data, data in enumerate(data_loader):
             (inputs, attention_mask, labels_demo) = data
             inputs = inputs.to(device)
@@ -66,17 +62,27 @@ def predict(model, data_loader, device='cpu'):
             pred_sin[mask_cant_be_sin] = -1
 
             pred_labels = np.concatenate((pred_nikud, pred_dagesh, pred_sin), axis=2)
+            batches_labels.append(pred_labels)
+
+    if not batches_labels:
+        return None
 
-            if all_labels is None:
-                all_labels = pred_labels
-            else:
-                all_labels = np.concatenate((all_labels, pred_labels), axis=0)
+    # with dynamic padding the batches have different lengths, so pad them all to the longest one
+    max_length = max(pred_labels.shape[1] for pred_labels in batches_labels)
+    all_labels = np.full((sum(len(pred_labels) for pred_labels in batches_labels), max_length, 3),
+                         Nikud.PAD_OR_IRRELEVANT, dtype=batches_labels[0].dtype)
+    start = 0
+    for pred_labels in batches_labels:
+        all_labels[start:start + len(pred_labels), :pred_labels.shape[1]] = pred_labels
+        start += len(pred_labels)
 
     return all_labels
 
 
 def training(model, train_loader, dev_loader, criterion_nikud, criterion_dagesh, criterion_sin, training_params, logger,
              output_model_path, optimizer, device='cpu'):
+    from tqdm import tqdm
+
     max_length = None
     best_accuracy = 0.0
 
@@ -97,41 +103,60 @@ def training(model, train_loader, dev_loader, criterion_nikud, criterion_dagesh,
     dev_loss_values = {"nikud": [], "dagesh": [], "sin": []}
     dev_accuracy_values = {"nikud": [], "dagesh": [], "sin": [], "all_nikud_letter": [], "all_nikud_word": []}
 
+    accumulation_steps = training_params.get("accumulation_steps", 1)
+    bf16 = training_params.get("bf16", False)
+    # the train batches hold the frozen encoder's features instead of token ids, see src/feature_store.py
+    features = training_params.get("features", False)
+    device_type = torch.device(device).type
+
     for epoch in tqdm(range(training_params["n_epochs"]), desc="Training"):
         model.train()
         train_loss = {"nikud": 0.0, "dagesh": 0.0, "sin": 0.0}
         relevant_count = {"nikud": 0.0, "dagesh": 0.0, "sin": 0.0}
+        # the mean losses of the steps stay on the device until the end of the epoch, so steps don't wait for them
+        steps_loss = {"nikud": [], "dagesh": [], "sin": []}
+        num_sentences = 0
+        start_time = time.time()
 
+        optimizer.zero_grad()
         for index_data, data in enumerate(train_loader):
             (inputs, attention_mask, labels) = data
 
             if max_length is None:
                 max_length = labels.shape[1]
 
-            inputs = inputs.to(device)
-            attention_mask = attention_mask.to(device)
-            labels = labels.to(device)
+            inputs = inputs.to(device, non_blocking=True)
+            attention_mask = attention_mask.to(device, non_blocking=True)
+            labels = labels.to(device, non_blocking=True)
 
-            optimizer.zero_grad()
-            nikud_probs, dagesh_probs, sin_probs = model(inputs, attention_mask)
+            with torch.autocast(device_type=device_type, dtype=torch.bfloat16, enabled=bf16):
+                if features:
+                    nikud_probs, dagesh_probs, sin_probs = model.forward_heads(inputs)
+                else:
+                    nikud_probs, dagesh_probs, sin_probs = model(inputs, attention_mask)
 
+            # a single backward pass through the sum of the three losses, which are computed in float32
+            total_loss = 0.0
             for i, (probs, class_name) in enumerate(
                     zip([nikud_probs, dagesh_probs, sin_probs], CLASSES_LIST)):
-                reshaped_tensor = torch.transpose(probs, 1, 2).contiguous().view(probs.shape[0],
-                                                                                 probs.shape[2],
-                                                                                 probs.shape[1])
-                loss = criteria[class_name](reshaped_tensor, labels[:, :, i]).to(device)
+                reshaped_tensor = torch.transpose(probs.float(), 1, 2).contiguous().view(probs.shape[0],
+                                                                                         probs.shape[2],
+                                                                                         probs.shape[1])
+                loss = criteria[class_name](reshaped_tensor, labels[:, :, i])
 
                 num_relevant = (labels[:, :, i] != -1).sum()
-                train_loss[class_name] += loss.item() * num_relevant
+                train_loss[class_name] += loss.detach() * num_relevant
                 relevant_count[class_name] += num_relevant
+                steps_loss[class_name].append(train_loss[class_name] / relevant_count[class_name])
+                total_loss = total_loss + loss
 
-                loss.backward(retain_graph=True)
-
-            for i, class_name in enumerate(CLASSES_LIST):
-                train_steps_loss_values[class_name].append(float(train_loss[class_name] / relevant_count[class_name]))
+            # the gradients of accumulation_steps batches add up before each optimizer step
+            (total_loss / accumulation_steps).backward()
+            num_sentences += inputs.shape[0]
+            if (index_data + 1) % accumulation_steps == 0:
+                optimizer.step()
+                optimizer.zero_grad()
 
-            optimizer.step()
             if (index_data + 1) % 100 == 0:
                 msg = f'epoch: {epoch} , index_data: {index_data + 1}\n'
                 for i, class_name in enumerate(CLASSES_LIST):
@@ -139,6 +164,23 @@ def training(model, train_loader, dev_loader, criterion_nikud, criterion_dagesh,
 
                 logger.debug(msg[:-2])
 
+        group_batches = (index_data + 1) % accumulation_steps if num_sentences else 0
+        if group_batches:
+            # the last group of the epoch has fewer batches, its losses were divided by accumulation_steps
+            # rather than by its own size. The loader of a stream has no length to know that up front
+            for param in model.parameters():
+                if param.grad is not None:
+                    param.grad.mul_(accumulation_steps / group_batches)
+            optimizer.step()
+            optimizer.zero_grad()
+
+        for class_name in CLASSES_LIST:
+            if steps_loss[class_name]:
+                train_steps_loss_values[class_name].extend(torch.stack(steps_loss[class_name]).tolist())
+        epoch_time = time.time() - start_time
+        logger.info(f"Epoch {epoch + 1}: trained on {num_sentences} sentences in {epoch_time:.1f}s, "
+                    f"{num_sentences / epoch_time:.1f} sentences/sec")
+
         for i, class_name in enumerate(CLASSES_LIST):
             train_epochs_loss_values[class_name].append(float(train_loss[class_name] / relevant_count[class_name]))
 
@@ -277,6 +319,11 @@ def save_dict_as_json(dict, file_path, file_name):
 
 
 def evaluate(model, test_data, plots_folder=None, device='cpu'):
+    # the reporting libraries are only needed here, importing them up front would slow down every other command
+    import pandas as pd
+    import seaborn as sns
+    from sklearn.metrics import confusion_matrix
+
     model.to(device)
     model.eval()
 
@@ -370,6 +417,7 @@ def evaluate(model, test_data, plots_folder=None, device='cpu'):
         cm_df = pd.DataFrame(cm, index=unique_vowels_names, columns=unique_vowels_names)
 
         # Display confusion matrix
+        plt = get_pyplot()
         plt.figure(figsize=(10, 8))
         sns.heatmap(cm_df, annot=True, cmap="Blues", fmt="d")
         plt.title("Confusion Matrix")
@@ -1,13 +1,20 @@
 # general
 import os
 
-# visual
-import matplotlib.pyplot as plt
-
 cols = ["precision", "recall", "f1-score", "support"]
 
 
+def get_pyplot():
+    # matplotlib is only imported by the commands that plot, so serving never loads it
+    import matplotlib
+    matplotlib.use('agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+
 def generate_plot_by_nikud_dagesh_sin_dict(nikud_dagesh_sin_dict, title, y_axis, plot_folder=None):
+    plt = get_pyplot()
+
     # Create a figure and axis
     plt.figure(figsize=(8, 6))
     plt.title(title)
@@ -34,6 +41,8 @@ def generate_plot_by_nikud_dagesh_sin_dict(nikud_dagesh_sin_dict, title, y_axis,
 
 
 def generate_word_and_letter_accuracy_plot(word_and_letter_accuracy_dict, title, plot_folder=None):
+    plt = get_pyplot()
+
     # Create a figure and axis
     plt.figure(figsize=(8, 6))
     plt.title(title)
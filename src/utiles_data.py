@@ -3,25 +3,16 @@ import os.path
 from datetime import datetime
 from pathlib import Path
 from typing import List, Tuple
-from uuid import uuid1
 import re
-import glob2
-
-# visual
-import matplotlib
-import matplotlib.pyplot as plt
-from tqdm import tqdm
 
 # ML
 import numpy as np
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import DataLoader, Dataset, IterableDataset, Sampler, get_worker_info
 
+from src.plot_helpers import get_pyplot
 from src.running_params import DEBUG_MODE, MAX_LENGTH_SEN
 
-matplotlib.use('agg')
-unique_key = str(uuid1())
-
 
 class Nikud:
     """
@@ -103,6 +94,33 @@ class Nikud:
         return ""
 
 
+# label id -> diacritic string per class, the extra last entry makes the -1 (irrelevant) label decode to ""
+ID_2_CHAR_TABLES = {class_type: np.array([chr(label) if label != "WITHOUT" else "" for label in id_2_label.values()] +
+                                         [""], dtype=object)
+                    for class_type, id_2_label in Nikud.id_2_label.items()}
+
+
+def labels_2_text(text, labels):
+    """
+    Puts the predicted diacritics on the text.
+
+    Args:
+        text (str): The text without diacritics.
+        labels (np.ndarray): (len(text), 3) array of nikud, dagesh and sin label ids per letter, -1 for none.
+            When it is shorter than the text (truncated sentences) the remaining letters are left without diacritics.
+
+    Returns:
+        str: The diacritized text, each letter followed by its dagesh, sin and nikud.
+    """
+    labels = np.asarray(labels)
+    pieces = np.empty((len(labels), 4), dtype=object)
+    pieces[:, 0] = list(text[:len(labels)])
+    pieces[:, 1] = ID_2_CHAR_TABLES["dagesh"][labels[:, 1]]
+    pieces[:, 2] = ID_2_CHAR_TABLES["sin"][labels[:, 2]]
+    pieces[:, 3] = ID_2_CHAR_TABLES["nikud"][labels[:, 0]]
+    return "".join(pieces.ravel().tolist()) + text[len(labels):]
+
+
 class Letters:
     hebrew = [chr(c) for c in range(0x05d0, 0x05ea + 1)]
     VALID_LETTERS = [' ', '!', '"', "'", '(', ')', ',', '-', '.', ':', ';', '?'] + hebrew
@@ -219,75 +237,268 @@ class Letter:
         return "לא ידוע ({})".format(hex(ord(letter)))
 
 
+class _NormalizeTable(dict):
+    # str.translate table that fills itself with Letter.normalize on first use of every character
+    def __missing__(self, key):
+        value = Letter(None).normalize(chr(key))
+        self[key] = value
+        return value
+
+
+NORMALIZE_TABLE = _NormalizeTable()
+
+# lookup table over code points: is it a diacritic (any of Nikud.nikud_dict)
+_NIKUD_TABLE_SIZE = max(Nikud.all_nikud_ord) + 1
+IS_NIKUD = np.zeros(_NIKUD_TABLE_SIZE, dtype=bool)
+IS_NIKUD[list(Nikud.all_nikud_ord)] = True
+# dropped wherever they are, the other diacritics only when they follow a newline
+IS_SKIPPED_NIKUD = np.zeros(_NIKUD_TABLE_SIZE, dtype=bool)
+IS_SKIPPED_NIKUD[[Nikud.nikud_dict['PUNCTUATION MAQAF'], Nikud.nikud_dict['PUNCTUATION PASEQ'],
+                  Nikud.nikud_dict['METEG']]] = True
+
+# a Hebrew letter and its first diacritics are packed into one int key, 5 bits each: the letter's offset from
+# alef, then the offset + 1 of each diacritic from the first one (0 for none)
+_FIRST_HEBREW = ord(Letters.hebrew[0])
+_LAST_HEBREW = ord(Letters.hebrew[-1])
+_FIRST_NIKUD = min(Nikud.all_nikud_ord)
+_KEY_BITS = 5
+_MAX_KEY_NIKUD = 3
+# key -> nikud, dagesh and sin label ids, filled by Letter.get_label_letter on first use of every key
+_KEY_LABELS = np.zeros((1 << (_KEY_BITS * (_MAX_KEY_NIKUD + 1)), 3), dtype=np.int8)
+_KEY_KNOWN = np.zeros(len(_KEY_LABELS), dtype=bool)
+
+
+def letter_labels(letter, nikud_ords):
+    l = Letter(letter)
+    l.get_label_letter(list(nikud_ords))
+    return l.nikud, l.dagesh, l.sin
+
+
+def _learn_key_labels(keys):
+    for key in np.unique(keys[~_KEY_KNOWN[keys]]).tolist():
+        letter = chr(_FIRST_HEBREW + (key & 31))
+        nikud_ords = []
+        for rank in range(1, _MAX_KEY_NIKUD + 1):
+            offset = (key >> (_KEY_BITS * rank)) & 31
+            if offset:
+                nikud_ords.append(_FIRST_NIKUD + offset - 1)
+        _KEY_LABELS[key] = letter_labels(letter, nikud_ords)
+        _KEY_KNOWN[key] = True
+
+
+def parse_diacritized(sentence):
+    """
+    Reads a diacritized sentence the way NikudDataset read it with one Letter per char, in bulk.
+
+    The diacritics following a Hebrew letter are its labels. The labels of every distinct letter and diacritics
+    combination are computed once with Letter.get_label_letter and kept in a lookup table, so its special cases (shin dot before
+    dagesh, shin with a dagesh only, vav with a dagesh, kamatz katan, ...) are kept exactly.
+
+    Returns:
+        Tuple[str, str, np.ndarray]: The normalized text, the original letters, and a (len(text), 3) array of
+            the nikud, dagesh and sin label ids of every letter, -1 where the letter can't have them.
+    """
+    codes = np.frombuffer(sentence.encode('utf-32-le', 'surrogatepass'), dtype=np.uint32).astype(np.int64)
+    is_nikud = np.zeros(len(codes), dtype=bool)
+    in_table = codes < _NIKUD_TABLE_SIZE
+    is_nikud[in_table] = IS_NIKUD[codes[in_table]]
+
+    base_positions = np.flatnonzero(~is_nikud)
+    base_codes = codes[base_positions]
+    base_is_hebrew = (base_codes >= _FIRST_HEBREW) & (base_codes <= _LAST_HEBREW)
+
+    # the letter each diacritic follows, -1 before the first one
+    nikud_positions = np.flatnonzero(is_nikud)
+    nikud_owner = np.cumsum(~is_nikud)[nikud_positions] - 1
+    owned = np.append(base_is_hebrew, False)[nikud_owner]
+
+    orphans = nikud_positions[~owned]
+    bad_orphans = orphans[~IS_SKIPPED_NIKUD[codes[orphans]] & (codes[orphans - 1] != ord('\n'))]
+    if len(bad_orphans):
+        raise ValueError(f"Diacritic {hex(codes[bad_orphans[0]])} at {bad_orphans[0]} doesn't follow a Hebrew letter")
+
+    nikud_owner = nikud_owner[owned]
+    nikud_codes = codes[nikud_positions[owned]]
+    rank = nikud_positions[owned] - base_positions[nikud_owner]
+    num_nikud = np.bincount(nikud_owner, minlength=len(base_positions))
+    in_key = rank <= _MAX_KEY_NIKUD
+    keys = base_codes - _FIRST_HEBREW + np.bincount(
+        nikud_owner[in_key], weights=(nikud_codes[in_key] - _FIRST_NIKUD + 1) << (_KEY_BITS * rank[in_key]),
+        minlength=len(base_positions)).astype(np.int64)
+
+    labels = np.full((len(base_positions), 3), Nikud.PAD_OR_IRRELEVANT, dtype=np.int64)
+    keyed = np.flatnonzero(base_is_hebrew & (num_nikud <= _MAX_KEY_NIKUD))
+    _learn_key_labels(keys[keyed])
+    labels[keyed] = _KEY_LABELS[keys[keyed]]
+    for base in np.flatnonzero(num_nikud > _MAX_KEY_NIKUD).tolist():
+        start = base_positions[base] + 1
+        labels[base] = letter_labels(chr(base_codes[base]), codes[start:start + num_nikud[base]].tolist())
+
+    text_org = base_codes.astype(np.uint32).tobytes().decode('utf-32-le', 'surrogatepass')
+    return text_org.translate(NORMALIZE_TABLE), text_org, labels
+
+
+# a sentence that contains one of these has labels, the others are plain text
+NIKUD_PATTERN = re.compile("[" + "".join(map(re.escape, sorted(Nikud.all_nikud_chr))) + "]")
+# a sentence longer than the max length is first broken after the end of each of its sentences
+LONG_SENTENCE_BREAK_PATTERN = re.compile(r'(?<=[.?!”] )|(?<=\t)')
+
+
 def text_contains_nikud(text):
-    return len(set(text) & Nikud.all_nikud_chr) > 0
+    return NIKUD_PATTERN.search(text) is not None
 
 
-def combine_sentences(list_sentences, max_length=0, is_train=False):
-    all_new_sentences = []
-    new_sen = ""
-    index = 0
-    while index < len(list_sentences):
-        sen = list_sentences[index]
+def split_lines(text):
+    # the lines of the text, each keeping its '\n', and then whatever follows the last '\n' (possibly "")
+    start = 0
+    while True:
+        end = text.find("\n", start)
+        if end == -1:
+            yield text[start:]
+            return
+        yield text[start:end + 1]
+        start = end + 1
+
+
+def break_long_sentence(sentence, max_length):
+    for part in LONG_SENTENCE_BREAK_PATTERN.split(sentence):
+        if len(part) < max_length:
+            yield part
+            continue
+        # cut the part into pieces of up to max_length chars, each ending at its last space if it has one
+        start = 0
+        while start <= len(part):
+            piece = part[start:start + max_length]
+            last_space = len(piece) - piece.rfind(" ") if " " in piece else 0
+            end = start + max_length - last_space
+            if end <= start:
+                # the only space is the first char, the old loop never got past it
+                end = start + max_length
+            yield part[start:end]
+            start = end
+
+
+def iter_combined_sentences(lines, max_length=0, is_train=False):
+    """
+    Groups the lines (each keeping its '\n') into sentences of less than max_length chars, in a single pass.
 
-        if not text_contains_nikud(sen) and ('------------------' in sen or sen == '\n'):
-            if len(new_sen) > 0:
-                all_new_sentences.append(new_sen)
+    Consecutive lines are joined while they fit, lines longer than max_length are broken with break_long_sentence
+    first. A separator line - a blank line or a "------------------" line without nikud - ends the current
+    sentence and is yielded on its own, except in training. In training, lines without nikud are dropped.
+    """
+    new_sen = ""
+    for line in lines:
+        pending = [line]
+        while pending:
+            sen = pending.pop()
+            has_nikud = text_contains_nikud(sen)
+
+            if not has_nikud and new_sen and ('------------------' in sen or sen == '\n'):
+                yield new_sen
                 if not is_train:
-                    all_new_sentences.append(sen)
+                    yield sen
                 new_sen = ""
-                index += 1
                 continue
 
-        if not text_contains_nikud(sen) and is_train:
-            index += 1
-            continue
+            if not has_nikud and is_train:
+                continue
+
+            if len(sen) > max_length:
+                # the parts go through the same checks, in order
+                pending.extend(reversed(list(break_long_sentence(sen, max_length))))
+                continue
+
+            if new_sen == "":
+                new_sen = sen
+            elif len(new_sen) + len(sen) < max_length:
+                new_sen += sen
+            else:
+                yield new_sen
+                new_sen = sen
+    if new_sen:
+        yield new_sen
+
+
+def combine_sentences(list_sentences, max_length=0, is_train=False):
+    return list(iter_combined_sentences(list_sentences, max_length=max_length, is_train=is_train))
 
-        if len(sen) > max_length:
-            update_sen = sen.replace(". ", f". {unique_key}")
-            update_sen = update_sen.replace("? ", f"? {unique_key}")
-            update_sen = update_sen.replace("! ", f"! {unique_key}")
-            update_sen = update_sen.replace("” ", f"” {unique_key}")
-            update_sen = update_sen.replace("\t", f"\t{unique_key}")
-            part_sentence = update_sen.split(unique_key)
-
-            good_parts = []
-            for p in part_sentence:
-                if len(p) < max_length:
-                    good_parts.append(p)
-                else:
-                    prev = 0
-                    while prev <= len(p):
-                        part = p[prev:(prev + max_length)]
-                        last_space = 0
-                        if " " in part:
-                            last_space = part[::-1].index(" ") + 1
-                        next = prev + max_length - last_space
-                        part = p[prev:next]
-                        good_parts.append(part)
-                        prev = next
-            list_sentences = list_sentences[:index] + good_parts + list_sentences[index + 1:]
-            continue
-        if new_sen == "":
-            new_sen = sen
-        elif len(new_sen) + len(sen) < max_length:
-            new_sen += sen
-        else:
-            all_new_sentences.append(new_sen)
-            new_sen = sen
 
-        index += 1
-    if len(new_sen) > 0:
-        all_new_sentences.append(new_sen)
-    return all_new_sentences
+def read_sentence_blocks(filepath, max_block_chars, max_length=MAX_LENGTH_SEN):
+    """
+    Reads a text file to predict in blocks of whole sentences of about max_block_chars chars, grouped exactly like
+    NikudDataset groups the whole file, without ever holding the file in memory.
+    """
+    block = []
+    block_chars = 0
+    with open(filepath, 'r', encoding='utf-8') as file:
+        for sentence in iter_combined_sentences(file, max_length=max_length):
+            block.append(sentence)
+            block_chars += len(sentence)
+            if block_chars >= max_block_chars:
+                yield block
+                block = []
+                block_chars = 0
+    if block:
+        yield block
+
+
+def list_data_files(folder_path):
+    import glob2
+
+    all_files = glob2.glob(f'{folder_path}/**/*.txt', recursive=True)
+    if DEBUG_MODE:
+        all_files = all_files[0:2]
+    return [file for file in all_files if "not_use" not in file and "NakdanResults" not in file]
+
+
+def pad_labels(labels, length, num_labeled):
+    # the labels of the start token, of the first num_labeled letters, and then of the end token and the padding
+    padded = torch.full((length, 3), Nikud.PAD_OR_IRRELEVANT, dtype=torch.long)
+    padded[1:num_labeled + 1] = torch.as_tensor(labels[:num_labeled])
+    return padded
+
+
+def encode_sentence(tokenizer, text, labels, max_length, padding="max_length"):
+    """
+    Tokenizes a sentence into an (input_ids, attention_mask, labels) tuple, padded to max_length with
+    padding="max_length" and left for PaddingCollator to pad otherwise.
+    """
+    encoded_sequence = tokenizer.encode_plus(
+        text,
+        add_special_tokens=True,
+        max_length=max_length,
+        padding='max_length' if padding == "max_length" else 'do_not_pad',
+        truncation=True,
+        return_attention_mask=True,
+        return_tensors='pt'
+    )
+    if padding == "max_length":
+        labels = pad_labels(labels, max_length, min(len(labels), max_length - 1))
+    else:
+        num_tokens = encoded_sequence['input_ids'].shape[1]
+        labels = pad_labels(labels, num_tokens, num_tokens - 2)
+    return encoded_sequence['input_ids'][0], encoded_sequence['attention_mask'][0], labels
 
 
 class NikudDataset(Dataset):
-    def __init__(self, tokenizer, folder=None, file=None, data_list=None, logger=None, max_length=0, is_train=False):
+    def __init__(self, tokenizer, folder=None, file=None, data_list=None, logger=None, max_length=0, is_train=False,
+                 cache_folder=None):
+        """
+        With a cache_folder, a folder or file is read from its pre-tokenized cache there (see
+        src/dataset_cache.py), which is built first when it is missing or out of date. The sentences are then
+        not held in memory: data and origin_data are None and prepare_data only wraps the memory mapped cache.
+        """
         self.max_length = max_length
         self.tokenizer = tokenizer
         self.is_train = is_train
-        if folder is not None:
+        self.cache = None
+        self.data = None
+        self.origin_data = None
+        if cache_folder is not None and (folder is not None or file is not None):
+            from src.dataset_cache import open_dataset_cache
+
+            self.cache = open_dataset_cache(self, folder if folder is not None else file, cache_folder, logger)
+        elif folder is not None:
             self.data, self.origin_data = self.read_data_folder(folder, logger)
         elif file is not None:
             self.data, self.origin_data = self.read_data(file, logger)
@@ -296,7 +507,7 @@ class NikudDataset(Dataset):
         self.prepered_data = None
 
     def read_data_folder(self, folder_path: str, logger=None):
-        all_files = glob2.glob(f'{folder_path}/**/*.txt', recursive=True)
+        all_files = list_data_files(folder_path)
         msg = f"number of files: " + str(len(all_files))
         if logger:
             logger.debug(msg)
@@ -304,18 +515,14 @@ class NikudDataset(Dataset):
             print(msg)
         all_data = []
         all_origin_data = []
-        if DEBUG_MODE:
-            all_files = all_files[0:2]
         for file in all_files:
-            if "not_use" in file or "NakdanResults" in file:
-                continue
             data, origin_data = self.read_data(file, logger)
             all_data.extend(data)
             all_origin_data.extend(origin_data)
         return all_data, all_origin_data
 
 
-    def read_data(self, filepath: str, logger=None) -> List[Tuple[str, list]]:
+    def read_data(self, filepath: str, logger=None) -> List[Tuple[str, np.ndarray]]:
         msg = f"read file: {filepath}"
         if logger:
             logger.debug(msg)
@@ -328,44 +535,16 @@ class NikudDataset(Dataset):
         return data, orig_data
 
 
-    def read_data_list(self, data_list: list, logger=None) -> List[Tuple[str, list]]:
+    def read_data_list(self, data_list: list, logger=None) -> List[Tuple[str, np.ndarray]]:
+        from tqdm import tqdm
+
         data = []
         orig_data = []
         for sen in tqdm(data_list, desc="read data list"):
             if sen == "":
                 continue
 
-            labels = []
-            text = ""
-            text_org = ""
-            index = 0
-            sentence_length = len(sen)
-            while index < sentence_length:
-                if ord(sen[index]) == Nikud.nikud_dict['PUNCTUATION MAQAF'] or ord(sen[index]) == Nikud.nikud_dict[
-                    'PUNCTUATION PASEQ'] or ord(sen[index]) == Nikud.nikud_dict['METEG']:
-                    index += 1
-                    continue
-
-                label = []
-                l = Letter(sen[index])
-                if not ( l.letter not in Nikud.all_nikud_chr):
-                    if sen[index-1] == '\n':
-                        index += 1
-                        continue
-                assert l.letter not in Nikud.all_nikud_chr
-                if sen[index] in Letters.hebrew:
-                    index += 1
-                    while index < sentence_length and ord(sen[index]) in Nikud.all_nikud_ord:
-                        label.append(ord(sen[index]))
-                        index += 1
-                else:
-                    index += 1
-
-                l.get_label_letter(label)
-                text += l.normalized
-                text_org += l.letter
-                labels.append(l)
-
+            text, text_org, labels = parse_diacritized(sen)
             data.append((text, labels))
             orig_data.append(text_org)
 
@@ -373,23 +552,25 @@ class NikudDataset(Dataset):
 
 
     def split_text(self, file_data):
-        file_data = file_data.replace("\n", f"\n{unique_key}")
-        data_list = file_data.split(unique_key)
-        data_list = combine_sentences(data_list, is_train=self.is_train, max_length=MAX_LENGTH_SEN)
-        return data_list
+        return combine_sentences(split_lines(file_data), is_train=self.is_train, max_length=MAX_LENGTH_SEN)
+
+    def all_labels(self):
+        # (number of letters, 3) nikud, dagesh and sin label ids of all the letters of the dataset
+        if self.cache is not None:
+            return self.cache.labels
+        return np.concatenate([labels for _, labels in self.data] + [np.empty((0, 3), dtype=np.int64)])
 
     def show_data_labels(self, plots_folder=None):
-        nikud = [Nikud.id_2_label["nikud"][label.nikud] for _, label_list in self.data for label in label_list if
-                  label.nikud != -1]
-        dagesh = [Nikud.id_2_label["dagesh"][label.dagesh] for _, label_list in self.data for label in label_list if
-                   label.dagesh != -1]
-        sin = [Nikud.id_2_label["sin"][label.sin] for _, label_list in self.data for label in label_list if
-               label.sin != -1]
+        all_labels = self.all_labels()
+        nikud = [Nikud.id_2_label["nikud"][label] for label in all_labels[:, 0].tolist() if label != -1]
+        dagesh = [Nikud.id_2_label["dagesh"][label] for label in all_labels[:, 1].tolist() if label != -1]
+        sin = [Nikud.id_2_label["sin"][label] for label in all_labels[:, 2].tolist() if label != -1]
 
         vowels = nikud + dagesh + sin
         unique_vowels, label_counts = np.unique(vowels, return_counts=True)
         unique_vowels_names = [Nikud.sign_2_name[int(vowel)] for vowel in unique_vowels if vowel != 'WITHOUT'] + [
             "WITHOUT"]
+        plt = get_pyplot()
         fig, ax = plt.subplots(figsize=(16, 6))
 
         bar_positions = np.arange(len(unique_vowels))
@@ -413,46 +594,142 @@ class NikudDataset(Dataset):
             self.max_length = maximum
         return self.max_length
 
-    def prepare_data(self, name="train"):
-        dataset = []
-        for index, (sentence, label) in tqdm(enumerate(self.data), desc=f"prepare data {name}"):
-            encoded_sequence = self.tokenizer.encode_plus(
-                sentence,
-                add_special_tokens=True,
-                max_length=self.max_length,
-                padding='max_length',
-                truncation=True,
-                return_attention_mask=True,
-                return_tensors='pt'
-            )
-            label_lists = [[letter.nikud, letter.dagesh, letter.sin] for letter in label]
-            label = torch.tensor(
-                [[Nikud.PAD_OR_IRRELEVANT, Nikud.PAD_OR_IRRELEVANT, Nikud.PAD_OR_IRRELEVANT]] + label_lists[:(
-                        self.max_length - 1)] + [
-                    [Nikud.PAD_OR_IRRELEVANT, Nikud.PAD_OR_IRRELEVANT, Nikud.PAD_OR_IRRELEVANT] for i in
-                    range(self.max_length - len(label) - 1)])
-
-            dataset.append((encoded_sequence['input_ids'][0], encoded_sequence['attention_mask'][0], label))
-
-        self.prepered_data = dataset
+    def prepare_data(self, name="train", padding="max_length"):
+        """
+        Tokenizes the sentences into (input_ids, attention_mask, labels) tuples.
+
+        With padding="max_length" every sentence is padded to self.max_length. With padding="longest" the
+        sentences are left unpadded and must be batched with PaddingCollator (see create_data_loader), so
+        each batch is only padded to its longest member.
+        """
+        if self.cache is not None:
+            self.prepered_data = self.cache.with_padding(padding)
+            return
+
+        from tqdm import tqdm
+
+        self.prepered_data = [encode_sentence(self.tokenizer, sentence, label, self.max_length, padding)
+                              for sentence, label in tqdm(self.data, desc=f"prepare data {name}")]
 
     def back_2_text(self, labels):
-        nikud = Nikud()
-        all_text = ""
-        for indx_sentance, (input_ids, _, label) in enumerate(self.prepered_data):
-            new_line = ""
-            for indx_char, c in enumerate(self.origin_data[indx_sentance]):
-                new_line += (c + nikud.id_2_char(labels[indx_sentance, indx_char + 1, 1], "dagesh") +
-                             nikud.id_2_char(labels[indx_sentance, indx_char + 1, 2], "sin") +
-                             nikud.id_2_char(labels[indx_sentance, indx_char + 1, 0], "nikud"))
-            all_text += new_line
-        return all_text
+        return "".join(self.back_2_sentences(labels))
+
+    def back_2_sentences(self, labels):
+        # position 0 is the start token, letter i sits at position i + 1
+        return [labels_2_text(origin, labels[indx_sentance, 1:len(origin) + 1])
+                for indx_sentance, origin in enumerate(self.origin_data)]
 
     def __len__(self):
-        return self.data.shape[0]
+        return len(self.cache) if self.cache is not None else len(self.data)
 
     def __getitem__(self, idx):
-        row = self.data[idx]
+        # tokenized on the fly, e.g. in DataLoader workers, and left for PaddingCollator to pad
+        if self.cache is not None:
+            return self.cache[idx]
+        sentence, label = self.data[idx]
+        return encode_sentence(self.tokenizer, sentence, label, self.max_length, padding="longest")
+
+
+class IterableNikudDataset(IterableDataset):
+    """
+    Streams the sentences of a data folder or file as (input_ids, attention_mask, labels) tuples, tokenized on the
+    fly and left for PaddingCollator to pad, without holding the corpus in memory.
+
+    The files are read line by line and split into sentences like NikudDataset splits them. With several
+    DataLoader workers every worker reads all the files and only parses and tokenizes its share of the sentences.
+    """
+
+    def __init__(self, tokenizer, folder=None, file=None, max_length=0, is_train=False):
+        self.tokenizer = tokenizer
+        self.files = list_data_files(folder) if folder is not None else [file]
+        self.max_length = max_length
+        self.is_train = is_train
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        index = 0
+        for file in self.files:
+            with open(file, 'r', encoding='utf-8') as f:
+                for sentence in iter_combined_sentences(f, max_length=MAX_LENGTH_SEN, is_train=self.is_train):
+                    if sentence == "":
+                        continue
+                    if index % num_workers == worker_id:
+                        text, _, labels = parse_diacritized(sentence)
+                        yield encode_sentence(self.tokenizer, text, labels, self.max_length, padding="longest")
+                    index += 1
+
+
+class PaddingCollator:
+    """
+    Collates unpadded (input_ids, attention_mask, labels) tuples, padding the batch to its longest member.
+    """
+
+    def __init__(self, pad_token_id):
+        self.pad_token_id = pad_token_id
+
+    def __call__(self, batch):
+        max_length = max(len(input_ids) for input_ids, _, _ in batch)
+        input_ids = torch.full((len(batch), max_length), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(batch), max_length), dtype=torch.long)
+        labels = torch.full((len(batch), max_length, 3), Nikud.PAD_OR_IRRELEVANT, dtype=torch.long)
+        for index, (sentence_input_ids, sentence_attention_mask, sentence_labels) in enumerate(batch):
+            length = len(sentence_input_ids)
+            input_ids[index, :length] = sentence_input_ids
+            attention_mask[index, :length] = sentence_attention_mask
+            labels[index, :length] = sentence_labels
+        return input_ids, attention_mask, labels
+
+
+class LengthBucketBatchSampler(Sampler):
+    """
+    Yields batches of indices of sentences with similar lengths, so little of each batch is padding.
+    """
+
+    def __init__(self, lengths, batch_size):
+        self.order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+        self.batches = [self.order[start:start + batch_size] for start in range(0, len(self.order), batch_size)]
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+def create_data_loader(prepered_data, batch_size, padding="max_length", bucketing=False, pad_token_id=None):
+    """
+    Creates a DataLoader over NikudDataset.prepered_data.
+
+    Returns the loader and the order in which it yields the sentences (None when it keeps the data order).
+    Predictions made with a bucketed loader are put back in the data order with restore_order.
+    """
+    if padding == "max_length":
+        return DataLoader(prepered_data, batch_size=batch_size), None
+
+    collate_fn = PaddingCollator(pad_token_id)
+    if not bucketing:
+        return DataLoader(prepered_data, batch_size=batch_size, collate_fn=collate_fn), None
+
+    batch_sampler = LengthBucketBatchSampler([len(input_ids) for input_ids, _, _ in prepered_data], batch_size)
+    return DataLoader(prepered_data, batch_sampler=batch_sampler, collate_fn=collate_fn), batch_sampler.order
+
+
+def create_training_data_loader(dataset, batch_size, num_workers=0, pin_memory=False):
+    """
+    Creates a DataLoader over a NikudDataset or IterableNikudDataset itself, whose sentences are tokenized in the
+    num_workers worker processes while the model runs, and padded batch by batch to their longest member.
+    """
+    return DataLoader(dataset, batch_size=batch_size, collate_fn=PaddingCollator(dataset.tokenizer.pad_token_id),
+                      num_workers=num_workers, pin_memory=pin_memory, persistent_workers=num_workers > 0)
+
+
+def restore_order(labels, order):
+    if order is None:
+        return labels
+    restored = np.empty_like(labels)
+    restored[order] = labels
+    return restored
 
 
 def get_sub_folders_paths(main_folder):
@@ -0,0 +1,47 @@
+import json
+from collections import deque
+from concurrent.futures import Future
+
+from text_segmentation import split_sentences
+
+
+def completed_future(func, *args) -> Future:
+    future = Future()
+    try:
+        future.set_result(func(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def stream_predictions(text: str, submit, max_pending: int):
+    """
+    Splits the text into sentences and yields a future of each sentence's prediction, in order.
+
+    `submit` is a `str -> Future` callable, e.g. MicroBatcher.submit. Up to max_pending sentences are submitted
+    ahead of the one the caller waits for, so later sentences are predicted in batches while the earlier ones
+    are sent. Sentences still pending when the caller stops, e.g. because the client went away, are cancelled.
+    """
+    sentences = iter(split_sentences(text))
+    pending = deque()
+    try:
+        while True:
+            for sentence in sentences:
+                pending.append(submit(sentence))
+                if len(pending) >= max_pending:
+                    break
+            if not pending:
+                return
+            yield pending.popleft()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def ndjson_line(index: int, diacritized_text: str) -> str:
+    return json.dumps({"index": index, "diacritized_text": diacritized_text}, ensure_ascii=False) + "\n"
+
+
+def ndjson_error(error: Exception) -> str:
+    # the status line is already sent, so a failure mid stream is reported as the last line
+    return json.dumps({"error": f"Prediction failed: {error}"}) + "\n"
@@ -15,6 +15,19 @@ def send_request_to_Nikud(text, url="http://127.0.0.1:5000/predict"):
         print("Error:", response.status_code, response.text)
 
 
+def send_batch_request_to_Nikud(texts, url="http://127.0.0.1:5000/predict_batch"):
+    headers = {"Content-Type": "application/json"}
+    data = json.dumps({"texts": texts})
+
+    response = requests.post(url, headers=headers, data=data)
+
+    if response.status_code == 200:
+        print("Response:", response.json())
+        return response.json()["diacritized_texts"]
+    else:
+        print("Error:", response.status_code, response.text)
+
+
 if __name__ == "__main__":
     sample_text = "האם בתאריך עשרים וחמישה ביוני, ביום שני, בשעה ארבע ארבעים וחמש, במרפאה ברחוב הנביאים 2, חיפה, יתאים לכם תור אצל דוקטור אביטל, מומחה לרפואת עיניים?"
     out = send_request_to_Nikud(sample_text)
@@ -0,0 +1,57 @@
+import re
+
+# a sentence ends with . ! or ? followed by whitespace, or with a new line
+SENTENCE_END_PATTERN = re.compile(r'[.!?]+\s+|\n\s*')
+
+
+def split_sentences(text):
+    """
+    Splits the text into sentences, each one keeping the whitespace that follows it,
+    so "".join(split_sentences(text)) == text.
+    """
+    sentences = []
+    start = 0
+    for match in SENTENCE_END_PATTERN.finditer(text):
+        sentences.append(text[start:match.end()])
+        start = match.end()
+    if start < len(text):
+        sentences.append(text[start:])
+    return sentences
+
+
+# inside a sentence, prefer to break after punctuation and then after a space
+BREAK_PATTERNS = [re.compile(r'[,;:]\s+'), re.compile(r'\s+')]
+
+
+def split_long_sentence(sentence, max_length):
+    parts = []
+    while len(sentence) > max_length:
+        end = max_length
+        for pattern in BREAK_PATTERNS:
+            breaks = [match.end() for match in pattern.finditer(sentence, 0, max_length)]
+            if breaks:
+                end = breaks[-1]
+                break
+        parts.append(sentence[:end])
+        sentence = sentence[end:]
+    if sentence:
+        parts.append(sentence)
+    return parts
+
+
+def segment_text(text, max_length):
+    """
+    Splits the text into windows of at most max_length chars, packing whole sentences together where possible.
+    Sentences longer than max_length are broken at punctuation or spaces, so "".join(segment_text(...)) == text.
+    """
+    windows = []
+    window = ""
+    for sentence in split_sentences(text):
+        for part in split_long_sentence(sentence, max_length):
+            if len(window) + len(part) > max_length:
+                windows.append(window)
+                window = ""
+            window += part
+    if window:
+        windows.append(window)
+    return windows